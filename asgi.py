@@ -0,0 +1,177 @@
+import asyncio
+import inspect
+import io
+import json
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from metrics import HTTP_REQUEST_SECONDS
+
+Request = namedtuple("Request", ["method", "path", "args", "headers", "client"])
+Response = namedtuple("Response", ["body", "status", "headers"])
+
+
+def json_response(data, status=200, headers=None):
+    return Response(
+        json.dumps(data).encode("utf-8"),
+        status,
+        dict({"content-type": "application/json"}, **(headers or {})),
+    )
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI http `scope` and its complete request `body`."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name, value = name.decode("latin-1"), value.decode("latin-1")
+        if name in ("content-type", "content-length"):
+            key = name.upper().replace("-", "_")
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class ThreadPoolWsgi:
+    """Serve a WSGI app over ASGI, each request on one of `threads` worker threads.
+
+    The request body is read before the app runs, and the response is sent
+    once the app has produced all of it: enough for the small JSON and image
+    responses of the Flask routes, not for streaming.
+    """
+
+    def __init__(self, wsgi_app, threads=32):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(
+            self.executor, self._run, wsgi_environ(scope, b"".join(body))
+        )
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+    def _run(self, environ):
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response["status"], response["headers"], b"".join(chunks)
+
+
+class AsgiApp:
+    """ASGI front for a Flask app with natively async hot routes.
+
+    Routes registered with `route()` run as coroutines on the event loop;
+    every other request falls through to the wrapped Flask app, which keeps
+    running unchanged on a pool of `wsgi_threads` threads. Patterns use
+    Flask's `<name>` syntax. `on_startup`/`on_shutdown`, plain or coroutine
+    functions, hook into the ASGI lifespan.
+    """
+
+    def __init__(self, wsgi_app, on_startup=None, on_shutdown=None, wsgi_threads=32):
+        self.fallback = ThreadPoolWsgi(wsgi_app, wsgi_threads)
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.routes = []
+
+    def route(self, pattern, methods=("GET",)):
+        regex = re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", pattern) + "$")
+
+        def decorator(handler):
+            self.routes.append((regex, pattern, methods, handler))
+            return handler
+        return decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] == "http":
+            for regex, pattern, methods, handler in self.routes:
+                match = regex.match(scope["path"])
+                if match and scope["method"] in methods:
+                    start = time.perf_counter()
+                    status = await self._dispatch(handler, match.groupdict(), scope, send)
+                    HTTP_REQUEST_SECONDS.observe(
+                        time.perf_counter() - start,
+                        route=pattern, method=scope["method"], status=status,
+                    )
+                    return
+        await self.fallback(scope, receive, send)
+
+    async def _dispatch(self, handler, params, scope, send):
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        request = Request(
+            method=scope["method"],
+            path=scope["path"],
+            args={k: v[0] for k, v in query.items()},
+            headers={k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])},
+            client=(scope.get("client") or ("", 0))[0],
+        )
+        try:
+            response = await handler(request, **params)
+        except Exception as e:
+            response = json_response({"error": str(e)}, 500)
+        await send({
+            "type": "http.response.start",
+            "status": response.status,
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items()],
+        })
+        await send({"type": "http.response.body", "body": response.body})
+        return response.status
+
+    async def _run_hook(self, hook):
+        if hook is not None:
+            result = hook()
+            if inspect.isawaitable(result):
+                await result
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self._run_hook(self.on_startup)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self._run_hook(self.on_shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
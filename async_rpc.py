@@ -0,0 +1,72 @@
+import asyncio
+import itertools
+import json
+import time
+
+from pyln.client import RpcError
+
+# Largest JSON-RPC response we accept (listinvoices on a busy node is big)
+RESPONSE_LIMIT = 64 * 1024 * 1024
+
+
+class AsyncLightningRpc:
+    """asyncio client for the Core Lightning unix-socket JSON-RPC.
+
+    Mirrors the LightningRpc calling convention (`await rpc.invoice(...)`), but
+    waits on the socket in the event loop instead of blocking a thread, so a
+    long `pay` or `waitanyinvoice` costs nothing but an open socket.
+    `on_call(method, elapsed, error)` is invoked after each call, e.g. with
+    RpcPool.record to share latency counters with the synchronous pool.
+    """
+
+    def __init__(self, socket_path, caller_name="lnurl-async", on_call=None):
+        self.socket_path = socket_path
+        self.caller_name = caller_name
+        self.on_call = on_call
+        self._ids = itertools.count(1)
+
+    async def call(self, method, payload=None):
+        if isinstance(payload, dict):
+            payload = {k: v for k, v in payload.items() if v is not None}
+        request = {
+            "jsonrpc": "2.0",
+            "id": f"{self.caller_name}:{method}#{next(self._ids)}",
+            "method": method,
+            "params": payload if payload is not None else {},
+        }
+        start = time.perf_counter()
+        try:
+            response = await self._roundtrip(request)
+        except Exception:
+            self._record(method, start, error=True)
+            raise
+        if "error" in response:
+            self._record(method, start, error=True)
+            raise RpcError(method, payload, response["error"])
+        self._record(method, start)
+        return response["result"]
+
+    async def _roundtrip(self, request):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path, limit=RESPONSE_LIMIT)
+        try:
+            writer.write(json.dumps(request).encode("utf-8"))
+            await writer.drain()
+            # lightningd terminates every JSON-RPC message with a blank line
+            data = await reader.readuntil(b"\n\n")
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        return json.loads(data)
+
+    def _record(self, method, start, error=False):
+        if self.on_call:
+            self.on_call(method, time.perf_counter() - start, error)
+
+    def __getattr__(self, name):
+        method = name.replace("_", "-")
+
+        async def wrapper(*args, **kwargs):
+            if args and kwargs:
+                raise RpcError(method, args, "Cannot mix positional and non-positional arguments")
+            return await self.call(method, list(args) if args else kwargs)
+        return wrapper
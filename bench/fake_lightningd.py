@@ -0,0 +1,250 @@
+"""Stand-in for the Core Lightning JSON-RPC unix socket, for benchmarks.
+
+Answers the subset of commands the apps use (getinfo, invoice, listinvoices,
+waitanyinvoice, pay, decodepay, listchannels, listpeerchannels, listfunds,
+delinvoice, autoclean-once) from memory, with a configurable per-call latency
+and a pre-generated invoice history and channel graph:
+
+    python bench/fake_lightningd.py --socket /tmp/bench/lightning-rpc \
+        --latency-ms 5 --invoices 100000 --channels 500
+
+Invoices are fake (`lnbcrt1fake<payment_hash>`) but `pay` on one of them
+marks it paid, so settlement through waitanyinvoice works end to end.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+NODE_ID = "02" + "ab" * 32
+PEER_ID = "03" + "cd" * 32
+
+
+class FakeNode:
+    def __init__(self, latency=0.0, jitter=0.0, invoices=0, channels=1, node_id=NODE_ID):
+        self.latency = latency
+        self.jitter = jitter
+        self.node_id = node_id
+        self.invoices = {}
+        self.by_bolt11 = {}
+        self.paid = []
+        self.channels = [self._channel(i) for i in range(max(channels, 1))]
+        self.calls = 0
+        self._cond = threading.Condition()
+        for i in range(invoices):
+            self._add_invoice(f"history_{i}", 1000 * (1 + i % 100), "history", 3600,
+                              paid=i % 3 == 0)
+
+    def _channel(self, i):
+        return {
+            "peer_id": PEER_ID if i == 0 else "03" + f"{i:064x}",
+            "state": "CHANNELD_NORMAL",
+            "peer_connected": True,
+            "short_channel_id": f"{100 + i}x1x0",
+            "receivable_msat": 10 ** 10,
+            "spendable_msat": 10 ** 9,
+        }
+
+    def _add_invoice(self, label, amount_msat, description, expiry, paid=False):
+        payment_hash = hashlib.sha256(label.encode()).hexdigest()
+        invoice = {
+            "label": label,
+            "payment_hash": payment_hash,
+            "bolt11": "lnbcrt1fake" + payment_hash,
+            "amount_msat": amount_msat,
+            "description": description,
+            "status": "unpaid",
+            "created_at": int(time.time()),
+            "expires_at": int(time.time()) + expiry,
+        }
+        self.invoices[payment_hash] = invoice
+        self.by_bolt11[invoice["bolt11"]] = invoice
+        if paid:
+            self._mark_paid(invoice)
+        return invoice
+
+    def _mark_paid(self, invoice):
+        self.paid.append(invoice)
+        invoice.update(status="paid", pay_index=len(self.paid),
+                       amount_received_msat=invoice["amount_msat"], paid_at=int(time.time()))
+
+    def call(self, method, params):
+        self.calls += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+        handler = getattr(self, "rpc_" + method.replace("-", "_"), None)
+        if handler is None:
+            return -32601, f"Unknown command '{method}'"
+        return handler(**params)
+
+    def rpc_getinfo(self):
+        return {
+            "id": self.node_id,
+            "alias": "fake-lightningd",
+            "num_active_channels": len(self.channels),
+            "address": [{"type": "ipv4", "address": "127.0.0.1", "port": 9735}],
+            "binding": [],
+        }
+
+    def rpc_invoice(self, amount_msat, label, description, expiry=604800, **_):
+        with self._cond:
+            if hashlib.sha256(label.encode()).hexdigest() in self.invoices:
+                return 900, f"Duplicate label '{label}'"
+            invoice = self._add_invoice(label, amount_msat, description, expiry)
+        return {key: invoice[key] for key in ("bolt11", "payment_hash", "expires_at")}
+
+    def rpc_listinvoices(self, label=None, invstring=None, payment_hash=None, **_):
+        with self._cond:
+            if payment_hash:
+                invoices = [self.invoices[payment_hash]] if payment_hash in self.invoices else []
+            elif invstring:
+                invoices = [self.by_bolt11[invstring]] if invstring in self.by_bolt11 else []
+            elif label:
+                invoices = [inv for inv in self.invoices.values() if inv["label"] == label]
+            else:
+                invoices = list(self.invoices.values())
+            return {"invoices": [dict(inv) for inv in invoices]}
+
+    def rpc_delinvoice(self, label, status, **_):
+        with self._cond:
+            for invoice in list(self.invoices.values()):
+                if invoice["label"] == label:
+                    if invoice["status"] != status:
+                        return 905, "Invoice status mismatch"
+                    del self.invoices[invoice["payment_hash"]]
+                    del self.by_bolt11[invoice["bolt11"]]
+                    return invoice
+        return 905, "Unknown invoice"
+
+    def rpc_autoclean_once(self, subsystem, age):
+        return {"autoclean": {subsystem: {"cleaned": 0, "uncleaned": 0}}}
+
+    def rpc_waitanyinvoice(self, lastpay_index=0, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                if len(self.paid) > (lastpay_index or 0):
+                    return dict(self.paid[lastpay_index or 0])
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return 904, "Timed out"
+                self._cond.wait(remaining)
+
+    def rpc_pay(self, bolt11, **_):
+        with self._cond:
+            invoice = self.by_bolt11.get(bolt11)
+            if invoice is None:
+                return 205, "Could not find a route"
+            if invoice["status"] != "paid":
+                self._mark_paid(invoice)
+                self._cond.notify_all()
+        return {
+            "status": "complete",
+            "payment_hash": invoice["payment_hash"],
+            "payment_preimage": "00" * 32,
+            "amount_msat": invoice["amount_msat"],
+            "amount_sent_msat": invoice["amount_msat"],
+            "parts": 1,
+        }
+
+    def rpc_decodepay(self, bolt11, **_):
+        invoice = self.by_bolt11.get(bolt11)
+        if invoice is None:
+            return -32602, "Invalid bolt11: Bad bech32 string"
+        return {
+            "currency": "bcrt",
+            "payee": self.node_id,
+            "payment_hash": invoice["payment_hash"],
+            "amount_msat": invoice["amount_msat"],
+            "description": invoice["description"],
+            "created_at": invoice["created_at"],
+            "expiry": invoice["expires_at"] - invoice["created_at"],
+        }
+
+    def rpc_listchannels(self, short_channel_id=None, source=None, **_):
+        channels = [
+            {"source": self.node_id, "destination": ch["peer_id"], "short_channel_id": ch["short_channel_id"],
+             "active": True, "public": True, "amount_msat": ch["receivable_msat"] + ch["spendable_msat"]}
+            for ch in self.channels
+        ]
+        if short_channel_id:
+            channels = [ch for ch in channels if ch["short_channel_id"] == short_channel_id]
+        if source:
+            channels = [ch for ch in channels if ch["source"] == source]
+        return {"channels": channels}
+
+    def rpc_listpeerchannels(self, id=None):
+        return {"channels": [ch for ch in self.channels if id is None or ch["peer_id"] == id]}
+
+    def rpc_listfunds(self, spent=False):
+        return {"outputs": [], "channels": []}
+
+
+def _normalize_params(node, method, params):
+    if isinstance(params, dict):
+        return params
+    handler = getattr(node, "rpc_" + method.replace("-", "_"), None)
+    if handler is None:
+        return {}
+    names = handler.__code__.co_varnames[1:handler.__code__.co_argcount]
+    return dict(zip(names, params))
+
+
+def serve_connection(node, conn):
+    decoder = json.JSONDecoder()
+    buf = ""
+    with conn:
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            buf += data.decode()
+            while buf.strip():
+                try:
+                    request, end = decoder.raw_decode(buf.lstrip())
+                except ValueError:
+                    break
+                buf = buf.lstrip()[end:]
+                method = request["method"]
+                try:
+                    result = node.call(method, _normalize_params(node, method, request.get("params") or {}))
+                except TypeError as e:
+                    result = -32602, str(e)
+                response = {"jsonrpc": "2.0", "id": request.get("id")}
+                if isinstance(result, tuple):
+                    response["error"] = {"code": result[0], "message": result[1]}
+                else:
+                    response["result"] = result
+                conn.sendall(json.dumps(response).encode() + b"\n\n")
+
+
+def serve(node, path):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(512)
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=serve_connection, args=(node, conn), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", required=True, help="unix socket path to listen on")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fixed delay added to every call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random delay, uniform in [0, jitter]")
+    parser.add_argument("--invoices", type=int, default=0, help="invoices pre-loaded in the history")
+    parser.add_argument("--channels", type=int, default=1, help="channels reported by the node")
+    args = parser.parse_args()
+
+    node = FakeNode(args.latency_ms / 1000, args.jitter_ms / 1000, args.invoices, args.channels)
+    serve(node, args.socket)
+
+
+if __name__ == "__main__":
+    main()
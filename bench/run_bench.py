@@ -0,0 +1,312 @@
+"""Load-test both apps against a fake Lightning node.
+
+Starts bench/fake_lightningd.py, the merchant server on port 5000 and the
+client proxy on port 5001 (the proxy expects the server on 5000), each in
+its own process with a throwaway database, then runs the selected
+scenarios and prints one JSON document with throughput and latency
+percentiles per scenario:
+
+    python bench/run_bench.py --latency-ms 5 --history 50000 --output results.json
+
+Scenarios:
+    checkout_burst      concurrent GET /api/create_invoice/<amount>
+    concurrent_pollers  many clients polling /api/check_payment on pending invoices
+    large_history       /api/check_payment on random cards from a large history
+    generate_invoice    GET /generate_invoice/<amount> through the client proxy
+    lnurl_pay           GET /lnurl-pay?amount=<msat>
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_lightningd import NODE_ID  # noqa: E402
+
+SERVER_PORT = 5000
+CLIENT_PORT = 5001
+AMOUNTS = ["25", "50", "100"]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(make_url, concurrency, requests_total=None, duration=None):
+    """Call make_url() from `concurrency` threads until `requests_total`
+    requests are done or `duration` seconds have passed, and summarize."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    remaining = [requests_total]
+    deadline = time.monotonic() + duration if duration else None
+
+    def take():
+        with lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+        return deadline is None or time.monotonic() < deadline
+
+    def worker():
+        session = requests.Session()
+        while take():
+            url = make_url()
+            start = time.perf_counter()
+            try:
+                response = session.get(url, timeout=30)
+                ok = response.status_code < 400
+                status = response.status_code
+            except requests.RequestException as e:
+                ok, status = False, type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors.append(status)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    error_counts = {}
+    for status in errors:
+        error_counts[str(status)] = error_counts.get(str(status), 0) + 1
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "error_statuses": error_counts,
+        "concurrency": concurrency,
+        "duration_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 1) if wall else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p90_ms": round(percentile(latencies, 0.90) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+
+def seed_history(database_path, size):
+    """Fill the gift card table with `size` cards, a third of them settled.
+    Returns the payment hashes."""
+    from storage import Storage
+
+    storage = Storage(database_path)
+    storage.migrate()
+    hashes = [secrets.token_hex(32) for _ in range(size)]
+    for start in range(0, size, 5000):
+        chunk = hashes[start:start + 5000]
+        storage.insert_gift_cards(
+            [(secrets.token_hex(16), random.choice(AMOUNTS), h) for h in chunk]
+        )
+        storage.settle(chunk[::3])
+    storage.close()
+    return hashes
+
+
+def wait_for_socket(path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(path)
+                return
+            except OSError:
+                pass
+        time.sleep(0.05)
+    raise RuntimeError(f"fake node did not listen on {path}")
+
+
+def wait_for_http(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+class Environment:
+    """The fake node and both apps, running in child processes."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="lnbench-")
+        self.socket_path = os.path.join(self.workdir, "lightning-rpc")
+        self.database_path = os.path.join(self.workdir, "gift_cards.db")
+        self.processes = []
+        self.history = []
+
+    def __enter__(self):
+        args = self.args
+        self._spawn([
+            os.path.join(BENCH_DIR, "fake_lightningd.py"), "--socket", self.socket_path,
+            "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+            "--invoices", str(args.history), "--channels", str(args.channels),
+        ])
+        wait_for_socket(self.socket_path, timeout=120)
+        if args.history:
+            self.history = seed_history(self.database_path, args.history)
+
+        env = dict(
+            os.environ,
+            LIGHTNING_RPC_PATH=self.socket_path,
+            MERCHANT_NODE_ID=NODE_ID,
+            DATABASE_PATH=self.database_path,
+            INVOICE_POOL_SIZE=str(args.invoice_pool_size),
+            LOG_LEVEL=args.log_level,
+            # All load comes from one address: measure throughput, not the rate limiter
+            RATE_LIMIT_CREATE_PER_CLIENT="",
+            RATE_LIMIT_CREATE_GLOBAL="",
+            RATE_LIMIT_POLL_PER_CLIENT="",
+            RATE_LIMIT_POLL_GLOBAL="",
+        )
+        server = self._spawn([os.path.join(BENCH_DIR, "serve.py"), "server", "--port", str(SERVER_PORT)],
+                             dict(env, LOG_FILE=os.path.join(self.workdir, "server.log")))
+        wait_for_http(f"http://127.0.0.1:{SERVER_PORT}/api/rpc_stats", server)
+        client = self._spawn([os.path.join(BENCH_DIR, "serve.py"), "client", "--port", str(CLIENT_PORT)],
+                             dict(env, LOG_FILE=os.path.join(self.workdir, "client.log")))
+        wait_for_http(f"http://127.0.0.1:{CLIENT_PORT}/api/rpc_stats", client)
+        # Let the node state cache take its first snapshot
+        time.sleep(1)
+        return self
+
+    def _spawn(self, argv, env=None):
+        process = subprocess.Popen([sys.executable] + argv, cwd=self.workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.processes.append(process)
+        return process
+
+    def __exit__(self, *exc):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not self.args.keep_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def server_url(path):
+    return f"http://127.0.0.1:{SERVER_PORT}{path}"
+
+
+def client_url(path):
+    return f"http://127.0.0.1:{CLIENT_PORT}{path}"
+
+
+def scenario_checkout_burst(env, args):
+    return run_load(lambda: server_url(f"/api/create_invoice/{random.choice(AMOUNTS)}"),
+                    args.concurrency, requests_total=args.requests)
+
+
+def scenario_concurrent_pollers(env, args):
+    session = requests.Session()
+    hashes = [
+        session.get(server_url(f"/api/create_invoice/{random.choice(AMOUNTS)}")).json()["payment_hash"]
+        for _ in range(args.pollers)
+    ]
+    return run_load(lambda: server_url(f"/api/check_payment/{random.choice(hashes)}"),
+                    args.pollers, duration=args.duration)
+
+
+def scenario_large_history(env, args):
+    if not env.history:
+        return {"skipped": "run with --history N to seed an invoice history"}
+    return run_load(lambda: server_url(f"/api/check_payment/{random.choice(env.history)}"),
+                    args.concurrency, duration=args.duration)
+
+
+def scenario_generate_invoice(env, args):
+    return run_load(lambda: client_url(f"/generate_invoice/{random.choice(AMOUNTS)}"),
+                    args.concurrency, requests_total=args.requests)
+
+
+def scenario_lnurl_pay(env, args):
+    return run_load(lambda: server_url(f"/lnurl-pay?amount={random.randint(1, 1000) * 1000}"),
+                    args.concurrency, requests_total=args.requests)
+
+
+SCENARIOS = {
+    "checkout_burst": scenario_checkout_burst,
+    "concurrent_pollers": scenario_concurrent_pollers,
+    "large_history": scenario_large_history,
+    "generate_invoice": scenario_generate_invoice,
+    "lnurl_pay": scenario_lnurl_pay,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16, help="client threads per scenario")
+    parser.add_argument("--requests", type=int, default=1000, help="requests for fixed-size scenarios")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds for time-boxed scenarios")
+    parser.add_argument("--pollers", type=int, default=100, help="concurrent pollers")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="fake node latency per RPC call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random fake node latency")
+    parser.add_argument("--history", type=int, default=0, help="invoices/gift cards pre-loaded")
+    parser.add_argument("--channels", type=int, default=1, help="channels reported by the fake node")
+    parser.add_argument("--invoice-pool-size", type=int, default=0, help="INVOICE_POOL_SIZE for the server")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL for both apps")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for request mixes")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep logs and database afterwards")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    random.seed(args.seed)
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "keep_workdir")},
+        "python": platform.python_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "scenarios": {},
+    }
+    with Environment(args) as env:
+        for name in names:
+            results["scenarios"][name] = SCENARIOS[name](env, args)
+            print(f"{name}: {json.dumps(results['scenarios'][name])}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
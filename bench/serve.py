@@ -0,0 +1,35 @@
+"""Serve one of the apps with its background tasks, for benchmarks.
+
+    python bench/serve.py server --port 5000
+    python bench/serve.py client --port 5001
+
+Equivalent to running lnurl_server.py / lnurl_client.py directly, without
+the client's interactive LNURL checks at startup.
+"""
+import argparse
+import os
+import sys
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("app", choices=["server", "client"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+
+    if args.app == "server":
+        import lnurl_server as module
+    else:
+        import lnurl_client as module
+
+    module.start_background_tasks()
+    make_server(args.host, args.port, module.app, threaded=True).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Offline BOLT11 invoice decoding and signature verification.
+
+`decode()` parses an invoice into the same fields Core Lightning's
+`decodepay` returns and checks its signature by recovering the payee key,
+so invoices can be verified without a node round trip. Key recovery uses
+coincurve when it is installed and falls back to pure Python otherwise.
+Results are memoized per invoice string.
+"""
+import copy
+import functools
+import hashlib
+import re
+
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+_CHARSET_REV = {c: i for i, c in enumerate(CHARSET)}
+
+# 1 BTC in msat, divided by the HRP multiplier
+_MULTIPLIERS = {"": 10 ** 11, "m": 10 ** 8, "u": 10 ** 5, "n": 10 ** 2, "p": None}
+_HRP_RE = re.compile(r"^ln([a-z]+?)(?:(\d+)([munp]?))?$")
+
+DEFAULT_EXPIRY = 3600
+DEFAULT_MIN_FINAL_CLTV_EXPIRY = 18
+
+# secp256k1 domain parameters
+_P = 2 ** 256 - 2 ** 32 - 977
+_N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+_G = (
+    0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+    0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
+)
+
+
+class Bolt11Error(ValueError):
+    pass
+
+
+def _polymod(values):
+    generator = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1FFFFFF) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if (top >> i) & 1 else 0
+    return chk
+
+
+def _hrp_expand(hrp):
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def bech32_decode(bech):
+    """Split a bech32 string into (hrp, 5-bit groups), without BIP-173's length limit."""
+    if bech.lower() != bech and bech.upper() != bech:
+        raise Bolt11Error("Mixed-case bech32 string")
+    bech = bech.lower()
+    pos = bech.rfind("1")
+    if pos < 1 or pos + 7 > len(bech):
+        raise Bolt11Error("Bad bech32 separator")
+    hrp = bech[:pos]
+    try:
+        data = [_CHARSET_REV[c] for c in bech[pos + 1:]]
+    except KeyError:
+        raise Bolt11Error("Invalid bech32 character")
+    if _polymod(_hrp_expand(hrp) + data) != 1:
+        raise Bolt11Error("Bad bech32 checksum")
+    return hrp, data[:-6]
+
+
+def _to_int(groups):
+    value = 0
+    for group in groups:
+        value = value << 5 | group
+    return value
+
+
+def _to_bytes(groups, pad=False):
+    """Pack 5-bit groups into bytes; leftover bits are dropped, or zero-padded
+    to a full byte with `pad`."""
+    value, bits, out = 0, 0, bytearray()
+    for group in groups:
+        value = value << 5 | group
+        bits += 5
+        if bits >= 8:
+            bits -= 8
+            out.append(value >> bits & 0xFF)
+    if pad and bits:
+        out.append(value << (8 - bits) & 0xFF)
+    return bytes(out)
+
+
+def _parse_amount(hrp):
+    match = _HRP_RE.match(hrp)
+    if not match:
+        raise Bolt11Error(f"Invalid human-readable part: {hrp}")
+    currency, digits, multiplier = match.groups()
+    if digits is None:
+        return currency, None
+    if multiplier == "p":
+        if int(digits) % 10:
+            raise Bolt11Error("Sub-millisatoshi amount")
+        return currency, int(digits) // 10
+    return currency, int(digits) * _MULTIPLIERS[multiplier]
+
+
+def _parse_routes(data):
+    hops = []
+    for i in range(0, len(data) - 50, 51):
+        hop = data[i:i + 51]
+        hops.append({
+            "pubkey": hop[:33].hex(),
+            "short_channel_id": "{}x{}x{}".format(
+                int.from_bytes(hop[33:36], "big"), int.from_bytes(hop[36:39], "big"),
+                int.from_bytes(hop[39:41], "big")),
+            "fee_base_msat": int.from_bytes(hop[41:45], "big"),
+            "fee_proportional_millionths": int.from_bytes(hop[45:49], "big"),
+            "cltv_expiry_delta": int.from_bytes(hop[49:51], "big"),
+        })
+    return hops
+
+
+def _parse_fields(groups, decoded):
+    i = 0
+    while i + 3 <= len(groups):
+        tag = CHARSET[groups[i]]
+        length = groups[i + 1] << 5 | groups[i + 2]
+        field = groups[i + 3:i + 3 + length]
+        i += 3 + length
+        if len(field) != length:
+            raise Bolt11Error("Truncated tagged field")
+        # Fields with an unexpected length are skipped, as BOLT11 requires
+        if tag == "p" and length == 52:
+            decoded.setdefault("payment_hash", _to_bytes(field).hex())
+        elif tag == "s" and length == 52:
+            decoded.setdefault("payment_secret", _to_bytes(field).hex())
+        elif tag == "h" and length == 52:
+            decoded.setdefault("description_hash", _to_bytes(field).hex())
+        elif tag == "n" and length == 53:
+            decoded.setdefault("payee", _to_bytes(field).hex())
+        elif tag == "d":
+            decoded.setdefault("description", _to_bytes(field).decode("utf-8", "replace"))
+        elif tag == "x":
+            decoded["expiry"] = _to_int(field)
+        elif tag == "c":
+            decoded["min_final_cltv_expiry"] = _to_int(field)
+        elif tag == "9":
+            decoded["features"] = format(_to_int(field), "x")
+        elif tag == "m":
+            decoded["payment_metadata"] = _to_bytes(field).hex()
+        elif tag == "f" and field:
+            decoded.setdefault("fallbacks", []).append(
+                {"version": field[0], "hex": _to_bytes(field[1:]).hex()})
+        elif tag == "r":
+            decoded.setdefault("routes", []).append(_parse_routes(_to_bytes(field)))
+
+
+def _point_add(a, b):
+    """Add two points in Jacobian coordinates (None is the point at infinity)."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x1, y1, z1 = a
+    x2, y2, z2 = b
+    z1z1, z2z2 = z1 * z1 % _P, z2 * z2 % _P
+    u1, u2 = x1 * z2z2 % _P, x2 * z1z1 % _P
+    s1, s2 = y1 * z2 * z2z2 % _P, y2 * z1 * z1z1 % _P
+    if u1 == u2:
+        return _point_double(a) if s1 == s2 else None
+    h, r = (u2 - u1) % _P, (s2 - s1) % _P
+    hh = h * h % _P
+    hhh = h * hh % _P
+    v = u1 * hh % _P
+    x3 = (r * r - hhh - 2 * v) % _P
+    y3 = (r * (v - x3) - s1 * hhh) % _P
+    return x3, y3, h * z1 * z2 % _P
+
+
+def _point_double(a):
+    if a is None or a[1] == 0:
+        return None
+    x, y, z = a
+    yy = y * y % _P
+    s = 4 * x * yy % _P
+    m = 3 * x * x % _P
+    x3 = (m * m - 2 * s) % _P
+    return x3, (m * (s - x3) - 8 * yy * yy) % _P, 2 * y * z % _P
+
+
+def _point_mul(point, k):
+    result = None
+    while k:
+        if k & 1:
+            result = _point_add(result, point)
+        point = _point_double(point)
+        k >>= 1
+    return result
+
+
+def _to_affine(point):
+    x, y, z = point
+    z_inv = pow(z, -1, _P)
+    return x * z_inv * z_inv % _P, y * z_inv * z_inv * z_inv % _P
+
+
+def _recover_pubkey_python(signature, msg_hash):
+    r = int.from_bytes(signature[:32], "big")
+    s = int.from_bytes(signature[32:64], "big")
+    recid = signature[64]
+    if not (0 < r < _N and 0 < s < _N) or recid > 3:
+        raise Bolt11Error("Invalid signature")
+    x = r + (recid >> 1) * _N
+    if x >= _P:
+        raise Bolt11Error("Invalid signature")
+    y = pow((pow(x, 3, _P) + 7) % _P, (_P + 1) // 4, _P)
+    if (y * y - x ** 3 - 7) % _P:
+        raise Bolt11Error("Invalid signature")
+    if y & 1 != recid & 1:
+        y = _P - y
+    e = int.from_bytes(msg_hash, "big")
+    r_inv = pow(r, -1, _N)
+    point = _point_add(
+        _point_mul((x, y, 1), s * r_inv % _N),
+        _point_mul((_G[0], _G[1], 1), -e * r_inv % _N),
+    )
+    if point is None:
+        raise Bolt11Error("Invalid signature")
+    qx, qy = _to_affine(point)
+    return bytes([2 + (qy & 1)]) + qx.to_bytes(32, "big")
+
+
+def recover_pubkey(signature, msg_hash):
+    """Compressed public key that produced a 65-byte (r, s, recid) signature."""
+    if coincurve is not None:
+        try:
+            return coincurve.PublicKey.from_signature_and_message(
+                signature, msg_hash, hasher=None).format()
+        except Exception as e:
+            raise Bolt11Error(f"Invalid signature: {e}")
+    return _recover_pubkey_python(signature, msg_hash)
+
+
+@functools.lru_cache(maxsize=1024)
+def _decode(bolt11):
+    if bolt11.lower().startswith("lightning:"):
+        bolt11 = bolt11[10:]
+    hrp, groups = bech32_decode(bolt11)
+    if len(groups) < 7 + 104:
+        raise Bolt11Error("Invoice too short")
+    currency, amount_msat = _parse_amount(hrp)
+
+    decoded = {"currency": currency, "created_at": _to_int(groups[:7])}
+    if amount_msat is not None:
+        decoded["amount_msat"] = amount_msat
+    _parse_fields(groups[7:-104], decoded)
+    decoded.setdefault("expiry", DEFAULT_EXPIRY)
+    decoded.setdefault("min_final_cltv_expiry", DEFAULT_MIN_FINAL_CLTV_EXPIRY)
+    if "payment_hash" not in decoded:
+        raise Bolt11Error("Missing payment hash")
+
+    signature = _to_bytes(groups[-104:])
+    msg_hash = hashlib.sha256(hrp.encode() + _to_bytes(groups[:-104], pad=True)).digest()
+    payee = recover_pubkey(signature, msg_hash).hex()
+    if decoded.setdefault("payee", payee) != payee:
+        raise Bolt11Error("Signature does not match payee")
+    decoded["signature"] = signature[:64].hex()
+    return decoded
+
+
+def decode(bolt11):
+    """Decode and verify a BOLT11 invoice; raise Bolt11Error if it is invalid."""
+    return copy.deepcopy(_decode(bolt11.strip()))
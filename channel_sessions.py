@@ -0,0 +1,215 @@
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import Counter
+from payments import QueueFull
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_OPENS = Counter("lnurl_channel_opens_total", "LNURL-channel opens by outcome", ["status"])
+
+# A session is 'issued' with its k1, 'queued' once a wallet claims it, then
+# 'opening' and 'opened' or 'failed'; a wallet may also cancel an issued k1.
+SESSION_FIELDS = ["k1", "status", "remote_id", "amount", "private", "result", "error", "expires_at"]
+
+
+class MemorySessionStore:
+    """k1 sessions in this process, bounded to `max_sessions`.
+
+    An issued k1 can be claimed once, within `ttl` seconds. Sessions are
+    kept for `retention` seconds after their k1 expires, for status queries.
+    """
+
+    def __init__(self, ttl=600, retention=86400, max_sessions=10_000):
+        self.ttl = ttl
+        self.retention = retention
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self):
+        k1 = secrets.token_hex(32)
+        now = time.time()
+        with self._lock:
+            self._sessions[k1] = dict.fromkeys(SESSION_FIELDS, None)
+            self._sessions[k1].update(k1=k1, status="issued", expires_at=now + self.ttl)
+            while self._sessions:
+                oldest = next(iter(self._sessions.values()))
+                if len(self._sessions) <= self.max_sessions and oldest["expires_at"] + self.retention >= now:
+                    break
+                self._sessions.popitem(last=False)
+        return k1
+
+    def claim(self, k1, remote_id, amount, private):
+        """Move an issued, unexpired session to 'queued'; False if k1 is unknown, expired or used."""
+        with self._lock:
+            session = self._sessions.get(k1)
+            if session is None or session["status"] != "issued" or session["expires_at"] < time.time():
+                return False
+            session.update(status="queued", remote_id=remote_id, amount=amount, private=private)
+            return True
+
+    def cancel(self, k1):
+        with self._lock:
+            session = self._sessions.get(k1)
+            if session is None or session["status"] != "issued":
+                return False
+            session["status"] = "cancelled"
+            return True
+
+    def update(self, k1, status, result=None, error=None):
+        with self._lock:
+            if k1 in self._sessions:
+                self._sessions[k1].update(status=status, result=result, error=error)
+
+    def get(self, k1):
+        with self._lock:
+            session = self._sessions.get(k1)
+            return dict(session) if session else None
+
+
+class SqliteSessionStore:
+    """k1 sessions in the shared database, so any worker process can answer the
+    callback or the status query for a k1 issued by another one."""
+
+    def __init__(self, storage, ttl=600, retention=86400, prune_every=100):
+        self.storage = storage
+        self.ttl = ttl
+        self.retention = retention
+        self.prune_every = prune_every
+        self._calls = 0
+
+    def issue(self):
+        k1 = secrets.token_hex(32)
+        now = time.time()
+        self._calls += 1
+        with self.storage.transaction() as conn:
+            if self._calls % self.prune_every == 0:
+                conn.execute('''
+                    DELETE FROM channel_sessions WHERE expires_at < ?
+                ''', (now - self.retention,))
+            conn.execute('''
+                INSERT INTO channel_sessions (k1, status, expires_at) VALUES (?, 'issued', ?)
+            ''', (k1, now + self.ttl))
+        return k1
+
+    def claim(self, k1, remote_id, amount, private):
+        with self.storage.transaction() as conn:
+            return conn.execute('''
+                UPDATE channel_sessions SET status = 'queued', remote_id = ?, amount = ?, private = ?
+                WHERE k1 = ? AND status = 'issued' AND expires_at >= ?
+            ''', (remote_id, amount, private, k1, time.time())).rowcount == 1
+
+    def cancel(self, k1):
+        with self.storage.transaction() as conn:
+            return conn.execute('''
+                UPDATE channel_sessions SET status = 'cancelled' WHERE k1 = ? AND status = 'issued'
+            ''', (k1,)).rowcount == 1
+
+    def update(self, k1, status, result=None, error=None):
+        with self.storage.transaction() as conn:
+            conn.execute('''
+                UPDATE channel_sessions SET status = ?, result = ?, error = ? WHERE k1 = ?
+            ''', (status, json.dumps(result) if result is not None else None, error, k1))
+
+    def get(self, k1):
+        with self.storage.connection() as conn:
+            row = conn.execute('''
+                SELECT k1, status, remote_id, amount, private, result, error, expires_at
+                FROM channel_sessions WHERE k1 = ?
+            ''', (k1,)).fetchone()
+        if row is None:
+            return None
+        session = dict(zip(SESSION_FIELDS, row))
+        session["private"] = bool(session["private"]) if session["private"] is not None else None
+        session["result"] = json.loads(session["result"]) if session["result"] else None
+        return session
+
+
+class ChannelOpener:
+    """Open claimed channel sessions on a bounded pool of worker threads.
+
+    `fund(session)` runs the node's `fundchannel`. With the default single
+    worker, channel opens from this process are funded one at a time, so
+    they never compete for the same wallet funds. `submit()` raises
+    QueueFull when `max_queued` opens are already waiting.
+
+    With several worker processes, pass a `lease` name: each open first
+    takes that lease in `storage`, so opens are serialised across processes
+    too. The lease is renewed while `fund` runs and expires after
+    `lease_ttl` seconds if its holder dies.
+    """
+
+    def __init__(self, fund, store, workers=1, max_queued=10,
+                 storage=None, lease=None, holder=None, lease_ttl=300, retry_delay=1):
+        self.fund = fund
+        self.store = store
+        self.workers = workers
+        self.storage = storage
+        self.lease = lease
+        self.holder = holder
+        self.lease_ttl = lease_ttl
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queued)
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"channel-opener-{i}", daemon=True).start()
+
+    def submit(self, k1):
+        try:
+            self._queue.put_nowait(k1)
+        except queue.Full:
+            raise QueueFull(f"{self._queue.maxsize} channel opens already queued")
+
+    @contextmanager
+    def _funding_lease(self):
+        if self.lease is None:
+            yield
+            return
+        holder = f"{self.holder}:{threading.current_thread().name}"
+        while not self.storage.acquire_lease(self.lease, holder, self.lease_ttl):
+            time.sleep(self.retry_delay)
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_lease, args=(holder, done),
+                                     name=f"{threading.current_thread().name}-lease", daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            done.set()
+            heartbeat.join()
+            self.storage.release_lease(self.lease, holder)
+
+    def _renew_lease(self, holder, done):
+        """Renew the lease every third of its TTL until `done`, however long fundchannel takes."""
+        while not done.wait(self.lease_ttl / 3):
+            try:
+                if not self.storage.acquire_lease(self.lease, holder, self.lease_ttl):
+                    logger.error(f"Lease {self.lease} lost by {holder} during a channel open")
+            except Exception as e:
+                logger.error(f"Lease {self.lease} renewal failed: {e}")
+
+    def _work(self):
+        while True:
+            k1 = self._queue.get()
+            try:
+                session = self.store.get(k1)
+                with self._funding_lease():
+                    self.store.update(k1, "opening")
+                    result = self.fund(session)
+                self.store.update(k1, "opened", {"txid": result.get("txid"), "channel_id": result.get("channel_id")})
+                CHANNEL_OPENS.inc(status="opened")
+                logger.info(f"Channel opened to {session['remote_id']}: {result.get('txid')}")
+            except Exception as e:
+                self.store.update(k1, "failed", error=str(e))
+                CHANNEL_OPENS.inc(status="failed")
+                logger.error(f"Channel open for k1 {k1[:8]}... failed: {e}")
+            finally:
+                self._queue.task_done()
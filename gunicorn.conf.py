@@ -0,0 +1,54 @@
+"""Multi-worker deployment of the merchant server.
+
+    gunicorn -c gunicorn.conf.py lnurl_server:app
+
+Every worker serves requests and runs its own node state refresh; the
+workers share the SQLite database (WAL mode) and elect one settlement
+watcher per merchant node through the leases table. LNURL-channel sessions
+default to the shared SQLite store, since a k1 issued by one worker may be
+claimed on another; channel opens take the 'fundchannel' lease, one at a
+time across workers. For the asyncio mode, run `lnurl_server_asgi:app`
+with GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker.
+"""
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# Long-poll requests hold a thread each in the threaded workers
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+timeout = 120
+graceful_timeout = 30
+
+# Inherited by the workers, which import lnurl_server after forking
+if not os.getenv("CHANNEL_SESSION_BACKEND"):
+    os.environ["CHANNEL_SESSION_BACKEND"] = "sqlite"
+
+
+def on_starting(server):
+    if server.num_workers > 1 and os.environ["CHANNEL_SESSION_BACKEND"] != "sqlite":
+        raise RuntimeError(
+            "CHANNEL_SESSION_BACKEND=sqlite is required with several workers: "
+            "a k1 issued by one worker is unknown to the others"
+        )
+    # Migrate once in the master, before any worker opens the database
+    from storage import Storage
+    storage = Storage(os.getenv("DATABASE_PATH", "gift_cards.db"))
+    storage.migrate()
+    storage.close()
+
+
+def post_worker_init(worker):
+    # Background threads do not survive fork: start them in each worker
+    import lnurl_server
+    lnurl_server.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    import lnurl_server
+    lnurl_server.stop_background_tasks()
@@ -0,0 +1,146 @@
+import logging
+import secrets
+import threading
+import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+PooledInvoice = namedtuple("PooledInvoice", ["label", "bolt11", "payment_hash", "expires_at", "amount_msat"])
+
+
+class InvoicePool:
+    """Keep `depth` unused invoices ready for each denomination.
+
+    `create(denomination, label)` must create the invoice on the node and
+    return its `invoice` RPC result, with the invoiced `amount_msat` added.
+    Invoices are handed out in constant time by `take()`, refilled in a
+    background thread and retired (deleted from the node) once they get
+    within `retire_margin` seconds of their expiry, so a customer always has
+    time to pay what they are given. Invoices that `take()` skips are left
+    for that thread to delete, so a checkout never calls the node. With a `price(denomination)` callback,
+    invoices more than `price_tolerance` (a fraction) away from the current
+    price are retired too, so small rate moves keep the pool; call
+    `refresh_soon()` after a price change.
+    """
+
+    def __init__(self, create, denominations, depth, retire_margin=600,
+                 check_interval=30, delete=None, price=None, price_tolerance=0.0):
+        self.create = create
+        self.delete = delete
+        self.price = price
+        self.price_tolerance = price_tolerance
+        self.denominations = list(denominations)
+        self.depth = depth
+        self.retire_margin = retire_margin
+        self.check_interval = check_interval
+        self._queues = {d: deque() for d in self.denominations}
+        # Retired by take(), deleted from the node by the refill thread
+        self._retired = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        # When each denomination's queue last dropped below `depth`
+        self._below_target_since = {}
+        self._stats = {d: {"hits": 0, "misses": 0, "retired": 0, "refill_lag_seconds": 0.0}
+                       for d in self.denominations}
+
+    def start(self):
+        threading.Thread(target=self._run, name="invoice-pool", daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def refresh_soon(self):
+        self._wake.set()
+
+    def _usable(self, denomination, invoice, deadline):
+        if invoice.expires_at <= deadline:
+            return False
+        if self.price is None:
+            return True
+        price = self.price(denomination)
+        return abs(invoice.amount_msat - price) <= price * self.price_tolerance
+
+    def take(self, denomination):
+        """Pop a ready invoice for `denomination`, or None if the pool is empty."""
+        deadline = time.time() + self.retire_margin
+        found = None
+        with self._lock:
+            queue = self._queues.get(denomination)
+            while queue:
+                # Checked before popping: if price() raises, the invoice stays queued
+                usable = self._usable(denomination, queue[0], deadline)
+                invoice = queue.popleft()
+                if usable:
+                    self._stats[denomination]["hits"] += 1
+                    found = invoice
+                    break
+                self._stats[denomination]["retired"] += 1
+                self._retired.append(invoice)
+            if queue is not None:
+                if found is None:
+                    self._stats[denomination]["misses"] += 1
+                self._mark_below_target(denomination)
+        self._wake.set()
+        return found
+
+    def _mark_below_target(self, denomination):
+        self._below_target_since.setdefault(denomination, time.monotonic())
+
+    def metrics(self):
+        with self._lock:
+            return {
+                d: dict(self._stats[d], depth=len(self._queues[d]), target=self.depth)
+                for d in self.denominations
+            }
+
+    def _retire_unusable(self):
+        deadline = time.time() + self.retire_margin
+        with self._lock:
+            retired = list(self._retired)
+            self._retired.clear()
+            for d, queue in self._queues.items():
+                usable = [invoice for invoice in queue if self._usable(d, invoice, deadline)]
+                if len(usable) < len(queue):
+                    retired.extend(invoice for invoice in queue if invoice not in usable)
+                    self._stats[d]["retired"] += len(queue) - len(usable)
+                    self._mark_below_target(d)
+                    self._queues[d] = deque(usable)
+        self._delete(retired)
+
+    def _delete(self, retired):
+        for invoice in retired:
+            if self.delete:
+                try:
+                    self.delete(invoice.label)
+                except Exception as e:
+                    logger.warning(f"Could not delete retired invoice {invoice.label}: {e}")
+
+    def _refill(self, denomination):
+        while not self._stop_event.is_set():
+            with self._lock:
+                if len(self._queues[denomination]) >= self.depth:
+                    since = self._below_target_since.pop(denomination, None)
+                    if since is not None:
+                        self._stats[denomination]["refill_lag_seconds"] = time.monotonic() - since
+                    return
+            label = f"giftcard_{secrets.token_hex(8)}"
+            invoice = self.create(denomination, label)
+            with self._lock:
+                self._queues[denomination].append(PooledInvoice(
+                    label, invoice['bolt11'], invoice['payment_hash'], invoice['expires_at'],
+                    invoice.get('amount_msat')
+                ))
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.clear()
+            try:
+                self._retire_unusable()
+                for denomination in self.denominations:
+                    self._refill(denomination)
+            except Exception as e:
+                logger.error(f"Invoice pool refill failed: {e}")
+            self._wake.wait(self.check_interval)
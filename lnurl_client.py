@@ -1,13 +1,18 @@
 import requests
-from hashlib import sha256
-from pyln.client import LightningRpc
 import json
-from flask import Flask, render_template, request, jsonify
-import qrcode
-import io
-import base64
+from flask import Flask, Response, render_template, request, jsonify
 from dotenv import load_dotenv
+import logging
 import os
+import time
+from cache import LruCache
+import lnurl_http
+from lnurl_http import LnurlClient
+from logging_setup import setup_logging
+from metrics import Gauge, instrument_flask
+from payments import PaymentQueue, QueueFull
+from qr import FORMATS as QR_FORMATS, QrRenderer
+from rpc_pool import RpcPool
 
 load_dotenv()
 
@@ -18,15 +23,42 @@ CLIENT_NODE_ID = os.getenv('CLIENT_NODE_ID')
 
 app = Flask(__name__)
 
+setup_logging(default_file='client.log')
+logger = logging.getLogger(__name__)
+instrument_flask(app)
+
 LNURL_SERVER = "http://localhost:5000"
 
+rpc_pool = RpcPool(LIGHTNING_RPC_PATH, size=int(os.getenv('RPC_POOL_SIZE', '8')))
+
+# Session HTTP partagée (connexions persistantes, délais, nouvelles tentatives) pour
+# les commandes LNURL et le proxy vers le serveur marchand
+lnurl = LnurlClient(
+    pool_size=int(os.getenv('LNURL_HTTP_POOL_SIZE', '16')),
+    timeout=(3.05, float(os.getenv('LNURL_HTTP_TIMEOUT', '15'))),
+    retries=int(os.getenv('LNURL_HTTP_RETRIES', '3'))
+)
+lnurl.mount_merchant(LNURL_SERVER)
+PAYOUT_CONCURRENCY = int(os.getenv('PAYOUT_CONCURRENCY', '8'))
+
+# Rendu des QR codes et correspondance payment_hash -> bolt11, bornés en mémoire
+qr_renderer = QrRenderer(max_entries=int(os.getenv('QR_CACHE_SIZE', '512')))
+invoices_by_hash = LruCache(int(os.getenv('QR_CACHE_SIZE', '512')))
+
+# Paiements exécutés par un pool de workers borné, hors des requêtes web
+payment_queue = PaymentQueue(
+    lambda bolt11: get_client().pay(bolt11),
+    workers=int(os.getenv('PAYMENT_WORKERS', '4')),
+    max_queued=int(os.getenv('PAYMENT_QUEUE_SIZE', '100')),
+    max_attempts=int(os.getenv('PAYMENT_MAX_ATTEMPTS', '3'))
+)
+
+PAYMENTS_IN_FLIGHT = Gauge("payments_in_flight", "Payment jobs queued, running or waiting to retry")
+PAYMENTS_IN_FLIGHT.set_function(payment_queue.in_flight)
+
 def get_client():
-    """Get an instance of the LightningRpc client."""
-    try:
-        return LightningRpc(LIGHTNING_RPC_PATH)
-    except Exception as e:
-        print(f"Error connecting to LightningRpc: {e}")
-        raise
+    """Get the pooled LightningRpc client shared by all requests."""
+    return rpc_pool.client
 
 def display_payment_dialog(lnurl_response, min_amount, max_amount):
     """Simulate a payment dialog with metadata and amount selection."""
@@ -52,20 +84,9 @@ def verify_invoice(invoice, metadata, expected_amount_msat):
         bool: True if the invoice is valid, False otherwise.
     """
     try:
-        # Step 1: Decode the invoice
-        client = get_client()
-        metadata_hash=sha256(metadata.encode('utf-8')).hexdigest()
-        decoded_invoice = client.decodepay(invoice)
-        invoice_metadata=decoded_invoice['description']
-        if metadata_hash!=invoice_metadata:
-            print("Metadata hash mismatch!")
-            return False
-        invoice_amount=int(decoded_invoice['amount_msat'])
-        if invoice_amount!=expected_amount_msat:
-            print(f"Amount mismatch! Invoice: {invoice_amount}, Expected: {expected_amount_msat}")
-            return False
+        # Decoded and checked locally, no node round trip
+        lnurl_http.verify_invoice(invoice, metadata, expected_amount_msat)
         return True
-    
     except Exception as e:
         print(f"Error verifying invoice: {e}")
         return False
@@ -73,7 +94,7 @@ def verify_invoice(invoice, metadata, expected_amount_msat):
 def lnurl_channel():
     """Test LNURL-channel interaction."""
     url = f"{BASE_URL}/lnurl2"
-    response = requests.get(url)
+    response = lnurl.get(url)
     # print("LNURL2 response:", response.json())
     if response.status_code == 200:
         lnurl_response = response.json()
@@ -95,15 +116,26 @@ def lnurl_channel():
         url= f"{BASE_URL}/{callback}?amount={amount}&k1={k1}&remote_id={node_id}&private={private}"
 
         print("Calling channel request callback...")
-        response = requests.get(url).json()
+        response = lnurl.get(url).json()
         print(f"Channel request response:\n{json.dumps(response, indent=4)}")
+
+        # The server opens the channel in the background; follow it until it settles
+        status_url = response.get("status_url")
+        for _ in range(60):
+            if not status_url:
+                break
+            status = lnurl.get(f"{BASE_URL}/{status_url}").json()
+            if status.get("state") in ("opened", "failed"):
+                print(f"Channel open {status['state']}: {status.get('result') or status.get('error')}")
+                break
+            time.sleep(1)
     else:
         print("Failed to connect to LNURL2 endpoint.")
 
 def lnurl_pay(amount):
     """Simulate an LNURL-pay interaction."""
     url = f"{BASE_URL}/lnurl6"
-    response = requests.get(url)
+    response = lnurl.get(url)
     if response.status_code != 200:
         print("Failed to connect to LNURL-pay endpoint.")
         return
@@ -136,7 +168,7 @@ def lnurl_pay(amount):
 
     # Step 4: Send amount to callback
     callback_url = f"{BASE_URL}/{callback}?amount={amount}"
-    payment_response = requests.get(callback_url)
+    payment_response = lnurl.get(callback_url)
     if payment_response.status_code != 200:
         print("Failed to send payment request to callback URL.")
         return
@@ -165,7 +197,7 @@ def lnurl_pay(amount):
 def lnurl_withdraw(amount):
     """Simulate an LNURL-withdraw interaction."""
     url = f"{BASE_URL}/lnurl-withdraw?amount={amount}"
-    response = requests.get(url)
+    response = lnurl.get(url)
     if response.status_code == 200:
         print("LNURL-withdraw response:", response.json())
     else:
@@ -174,7 +206,7 @@ def lnurl_withdraw(amount):
 def lnurl_auth():
     """Simulate an LNURL-auth interaction."""
     url = f"{BASE_URL}/lnurl-auth"
-    response = requests.get(url)
+    response = lnurl.get(url)
     if response.status_code == 200:
         print("LNURL-auth response:", response.json())
     else:
@@ -186,49 +218,106 @@ def lnurl_static(static):
     username=res[0]
     host=res[1]
     url = f"{BASE_URL}/.well-known/lnurlp/{username}"
-    response = requests.get(url)
+    response = lnurl.get(url)
     print("LNURL-static response:", response.json())
     if response.status_code == 200:
         print("LNURL-static response:", response)
     else:
         print("Failed to connect to LNURL-static endpoint.")
 
+def lnurl_payouts(payouts):
+    """Pay many LNURL-pay targets or lightning addresses at once.
+
+    `payouts` is a list of (target, amount_msat); targets are resolved and
+    paid concurrently over the shared HTTP session.
+    """
+    results = lnurl.pay_many(payouts, lambda bolt11: get_client().pay(bolt11), max_workers=PAYOUT_CONCURRENCY)
+    for result in results:
+        if result["status"] == "paid":
+            print(f"Paid {result['amount_msat']} msat to {result['target']}")
+        else:
+            print(f"Payout to {result['target']} failed: {result['error']}")
+    return results
+
+def forwarded_headers(remote_addr, forwarded_for=None):
+    """En-tête X-Forwarded-For pour le serveur marchand, qui limite le débit par acheteur."""
+    hops = [hop for hop in (forwarded_for, remote_addr) if hop]
+    return {"X-Forwarded-For": ", ".join(hops)} if hops else {}
+
+def shopper_headers():
+    return forwarded_headers(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+def retry_headers(response):
+    return {"Retry-After": response.headers["Retry-After"]} if "Retry-After" in response.headers else {}
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/generate_invoice/<amount>')
 def generate_invoice(amount):
-    print(f"Génération d'une facture pour {amount}€")  # Log
-    response = requests.get(f"{LNURL_SERVER}/api/create_invoice/{amount}")
+    response = lnurl.get(f"{LNURL_SERVER}/api/create_invoice/{amount}", headers=shopper_headers())
     if response.status_code == 200:
         data = response.json()
-        print("Facture générée avec succès")  # Log
-        
-        # Générer QR code
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(data['payment_request'])
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convertir l'image en base64
-        buffered = io.BytesIO()
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        print("QR code généré avec succès")  # Log
+        # Le QR code est servi à part par /qr/<payment_hash>, que le navigateur peut mettre en cache
+        invoices_by_hash.put(data['payment_hash'], data['payment_request'])
         
         return jsonify({
             "payment_request": data['payment_request'],
             "payment_hash": data['payment_hash'],
-            "qr_code": img_str
+            "qr_url": f"/qr/{data['payment_hash']}"
         })
-    print(f"Erreur: {response.text}")  # Log d'erreur
+    if response.status_code in (429, 503):
+        return response.json(), response.status_code, retry_headers(response)
+    logger.error("Erreur lors de la génération de la facture",
+                 extra={"amount": amount, "status": response.status_code, "response": response.text[:200]})
     return jsonify({"error": "Erreur lors de la génération de la facture"}), 500
 
+@app.route('/qr/<payment_hash>')
+def invoice_qr(payment_hash):
+    bolt11 = invoices_by_hash.get(payment_hash)
+    if bolt11 is None:
+        return jsonify({"error": "Facture inconnue"}), 404
+    fmt = request.args.get("format", "svg")
+    if fmt not in QR_FORMATS:
+        return jsonify({"error": "Format invalide"}), 400
+    
+    response = Response(qr_renderer.render(bolt11, fmt), mimetype=QR_FORMATS[fmt])
+    # L'image d'une facture ne change jamais
+    response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    response.set_etag(f"{payment_hash}-{fmt}")
+    return response.make_conditional(request)
+
+@app.route('/prices')
+def prices():
+    try:
+        response = lnurl.get(f"{LNURL_SERVER}/api/prices", headers=shopper_headers())
+        return response.json(), response.status_code
+    except requests.RequestException as e:
+        return jsonify({"error": str(e)}), 502
+
 @app.route('/check_payment/<payment_hash>')
 def check_payment(payment_hash):
-    response = requests.get(f"{LNURL_SERVER}/api/check_payment/{payment_hash}")
-    return response.json()
+    response = lnurl.get(f"{LNURL_SERVER}/api/check_payment/{payment_hash}", headers=shopper_headers())
+    return response.json(), response.status_code, retry_headers(response)
+
+@app.route('/wait_payment/<payment_hash>')
+def wait_payment(payment_hash):
+    """Long-poll proxy: returns as soon as the merchant server sees the payment."""
+    try:
+        timeout = float(request.args.get("timeout", 25))
+    except ValueError:
+        return jsonify({"error": "Timeout invalide"}), 400
+    try:
+        response = lnurl.get(
+            f"{LNURL_SERVER}/api/wait_payment/{payment_hash}",
+            params={"timeout": timeout},
+            headers=shopper_headers(),
+            timeout=timeout + 10,
+        )
+        return response.json(), response.status_code, retry_headers(response)
+    except requests.RequestException as e:
+        return jsonify({"error": str(e)}), 502
 
 @app.route('/pay_invoice/<bolt11>')
 def pay_invoice(bolt11):
@@ -236,15 +325,27 @@ def pay_invoice(bolt11):
         if not verify_node():
             return jsonify({"error": "Configuration incorrecte du nœud client"}), 500
         
-        client = get_client()
-        payment = client.pay(bolt11)
-        return jsonify({
-            "status": "success",
-            "payment": payment
-        })
+        job = payment_queue.submit(bolt11)
+        return jsonify(payment_job_response(job)), 202
+    except QueueFull:
+        return jsonify({"error": "Trop de paiements en attente"}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def payment_job_response(job):
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/payment_status/{job.id}"
+    }
+
+@app.route('/payment_status/<job_id>')
+def payment_status(job_id):
+    job = payment_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Paiement inconnu"}), 404
+    return jsonify(job.to_dict())
+
 def verify_node():
     try:
         client = get_client()
@@ -264,29 +365,39 @@ def test_payment():
         node_info = client.getinfo()
         
         # Créer une petite facture de test
-        response = requests.get(f"{LNURL_SERVER}/api/create_invoice/25")
+        response = lnurl.get(f"{LNURL_SERVER}/api/create_invoice/25")
         if response.status_code != 200:
             return jsonify({"error": "Erreur lors de la création de la facture"}), 500
             
         data = response.json()
         
-        # Tenter le paiement
-        payment = client.pay(data['payment_request'])
+        # Tenter le paiement en arrière-plan
+        job = payment_queue.submit(data['payment_request'])
         
-        return jsonify({
-            "client_node_id": node_info['id'],
-            "is_correct_client": node_info['id'] == CLIENT_NODE_ID,
-            "payment_status": payment['status'],
-            "payment_preimage": payment.get('payment_preimage')
-        })
+        return jsonify(dict(
+            payment_job_response(job),
+            client_node_id=node_info['id'],
+            is_correct_client=node_info['id'] == CLIENT_NODE_ID
+        )), 202
+    except QueueFull:
+        return jsonify({"error": "Trop de paiements en attente"}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/rpc_stats', methods=['GET'])
+def rpc_stats():
+    return jsonify(rpc_pool.stats())
+
+def start_background_tasks():
+    payment_queue.start()
+
 if __name__ == "__main__":
     # Test each function with sample values
     # lnurl_channel()  # Test LNURL-channel interaction
     # lnurl_pay(2500)  # Uncomment to test LNURL-pay
     # lnurl_withdraw(5000)  # Uncomment to test LNURL-withdraw
     # lnurl_auth()  # Uncomment to test LNURL-auth
+    # lnurl_payouts([("sosthene@localhost:5000", 2_500_000), (f"{BASE_URL}/lnurl6", 1_000_000)])  # Uncomment to test payouts
     lnurl_static("sosthene@sosthene.wtf")  # Test LNURL-static interaction
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
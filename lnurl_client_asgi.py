@@ -0,0 +1,86 @@
+"""Asyncio serving mode for the client proxy.
+
+Run with an ASGI server, e.g. `uvicorn lnurl_client_asgi:app --port 5001`.
+The proxy hop to the merchant server goes through a shared httpx.AsyncClient
+and payments are handed to the payment job queue, so neither a waiting
+checkout nor a slow route occupies a request thread; every other route is
+served by the Flask app in lnurl_client.py.
+"""
+import httpx
+
+import lnurl_client as client
+from asgi import AsgiApp, json_response
+from async_rpc import AsyncLightningRpc
+from payments import QueueFull
+
+async_rpc = AsyncLightningRpc(client.LIGHTNING_RPC_PATH, on_call=client.rpc_pool.record)
+
+http = httpx.AsyncClient(
+    base_url=client.LNURL_SERVER,
+    timeout=httpx.Timeout(10.0),
+    limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+)
+
+app = AsgiApp(client.app, on_startup=client.start_background_tasks, on_shutdown=http.aclose)
+
+
+def shopper_headers(request):
+    return client.forwarded_headers(request.client, request.headers.get("x-forwarded-for"))
+
+
+def passthrough(response):
+    return json_response(response.json(), response.status_code, client.retry_headers(response))
+
+
+@app.route("/generate_invoice/<amount>")
+async def generate_invoice(request, amount):
+    response = await http.get(f"/api/create_invoice/{amount}", headers=shopper_headers(request))
+    if response.status_code in (429, 503):
+        return passthrough(response)
+    if response.status_code != 200:
+        return json_response({"error": "Erreur lors de la génération de la facture"}, 500)
+    data = response.json()
+    client.invoices_by_hash.put(data['payment_hash'], data['payment_request'])
+    return json_response({
+        "payment_request": data['payment_request'],
+        "payment_hash": data['payment_hash'],
+        "qr_url": f"/qr/{data['payment_hash']}"
+    })
+
+
+@app.route("/check_payment/<payment_hash>")
+async def check_payment(request, payment_hash):
+    response = await http.get(f"/api/check_payment/{payment_hash}", headers=shopper_headers(request))
+    return passthrough(response)
+
+
+@app.route("/wait_payment/<payment_hash>")
+async def wait_payment(request, payment_hash):
+    try:
+        timeout = float(request.args.get("timeout", 25))
+    except ValueError:
+        return json_response({"error": "Timeout invalide"}, 400)
+    try:
+        response = await http.get(
+            f"/api/wait_payment/{payment_hash}",
+            params={"timeout": timeout},
+            headers=shopper_headers(request),
+            timeout=timeout + 10,
+        )
+    except httpx.HTTPError as e:
+        return json_response({"error": str(e)}, 502)
+    return passthrough(response)
+
+
+@app.route("/pay_invoice/<bolt11>")
+async def pay_invoice(request, bolt11):
+    try:
+        node_info = await async_rpc.getinfo()
+        if node_info['id'] != client.CLIENT_NODE_ID:
+            return json_response({"error": "Configuration incorrecte du nœud client"}, 500)
+        job = client.payment_queue.submit(bolt11)
+        return json_response(client.payment_job_response(job), 202)
+    except QueueFull:
+        return json_response({"error": "Trop de paiements en attente"}, 503)
+    except Exception as e:
+        return json_response({"error": str(e)}, 500)
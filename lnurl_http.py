@@ -0,0 +1,155 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import bolt11
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+PAYOUTS = Counter("lnurl_payouts_total", "LNURL-pay payouts by outcome", ["status"])
+
+# Hosts served over plain HTTP when resolving a lightning address (local test setup)
+LOCAL_HOSTS = {"localhost", "127.0.0.1"}
+
+
+class LnurlError(Exception):
+    pass
+
+
+def target_url(target):
+    """URL of the LNURL-pay document for a lightning address (user@host),
+    a bech32 LNURL (lnurl1...) or a plain URL."""
+    target = target.strip()
+    if target.lower().startswith("lightning:"):
+        target = target[len("lightning:"):]
+    if target.lower().startswith("lnurl1"):
+        _, groups = bolt11.bech32_decode(target)
+        return bolt11._to_bytes(groups).decode()
+    if "@" in target and "://" not in target:
+        username, host = target.split("@", 1)
+        scheme = "http" if host.split(":")[0] in LOCAL_HOSTS else "https"
+        return f"{scheme}://{host}/.well-known/lnurlp/{username}"
+    return target
+
+
+def callback_url(document_url, callback):
+    # Callbacks may be relative to the server root (the merchant server returns "lnurl-pay")
+    parts = urlsplit(document_url)
+    return urljoin(f"{parts.scheme}://{parts.netloc}/", callback)
+
+
+def verify_invoice(invoice, metadata, amount_msat):
+    """Check that `invoice` commits to the LNURL metadata and asks for `amount_msat`."""
+    decoded = bolt11.decode(invoice)
+    metadata_hash = sha256(metadata.encode("utf-8")).hexdigest()
+    # LNURL-pay commits to the metadata with the h tag; the merchant server puts the hash in d
+    if decoded.get("description_hash", decoded.get("description")) != metadata_hash:
+        raise LnurlError("Metadata hash mismatch")
+    if int(decoded["amount_msat"]) != amount_msat:
+        raise LnurlError(f"Amount mismatch: invoice {decoded['amount_msat']}, expected {amount_msat}")
+
+
+class LnurlClient:
+    """LNURL HTTP client over one keep-alive session.
+
+    Connections are pooled per host (`pool_size` each), every request has a
+    (connect, read) timeout, and connection failures and 502/503/504 answers
+    are retried with backoff. Read timeouts are not retried: the request may
+    already have created an invoice.
+    """
+
+    def __init__(self, pool_size=16, timeout=(3.05, 15), retries=3, backoff=0.3):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = self._adapter((502, 503, 504))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _adapter(self, status_forcelist):
+        retry = Retry(
+            total=self.retries, read=0, backoff_factor=self.backoff,
+            status_forcelist=status_forcelist, allowed_methods=frozenset(["GET"]),
+            # A 429 goes back to the caller instead of sleeping through its Retry-After
+            raise_on_status=False, respect_retry_after_header=False,
+        )
+        return HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+
+    def mount_merchant(self, base_url):
+        """Do not retry 503 answers from `base_url`, the merchant server: they
+        shed load on purpose, and each retry would spend a rate limit token."""
+        self.session.mount(base_url, self._adapter((502, 504)))
+
+    def close(self):
+        self.session.close()
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        try:
+            response = self.get(url, **kwargs)
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise LnurlError(f"{url}: {e}")
+        if isinstance(data, dict) and data.get("status") == "ERROR":
+            raise LnurlError(data.get("reason", "LNURL error"))
+        if response.status_code != 200:
+            raise LnurlError(f"{url}: HTTP {response.status_code}")
+        return data
+
+    def fetch_pay_request(self, target):
+        """Resolve a LNURL-pay target into its payRequest document, with an absolute callback."""
+        url = target_url(target)
+        document = self.get_json(url)
+        if document.get("tag") != "payRequest":
+            raise LnurlError("Invalid LNURL tag")
+        return dict(document, callback=callback_url(url, document["callback"]))
+
+    def request_invoice(self, pay_request, amount_msat):
+        """Ask the payRequest callback for an invoice and verify it before returning the bolt11."""
+        if not pay_request["minSendable"] <= amount_msat <= pay_request["maxSendable"]:
+            raise LnurlError(
+                f"Amount {amount_msat} out of bounds [{pay_request['minSendable']}, {pay_request['maxSendable']}]"
+            )
+        data = self.get_json(pay_request["callback"], params={"amount": amount_msat})
+        verify_invoice(data["pr"], pay_request["metadata"], amount_msat)
+        return data["pr"]
+
+    def pay_many(self, payouts, pay, max_workers=8):
+        """Pay every (target, amount_msat) in `payouts` concurrently.
+
+        Each distinct target is resolved once; `pay(bolt11)` settles one invoice
+        (e.g. the node's `pay`). Returns one result dict per payout, in order.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lnurl-payout") as executor:
+            # Queued first, so payout tasks never wait on a resolution that cannot start
+            documents = {
+                target: executor.submit(self.fetch_pay_request, target)
+                for target in dict.fromkeys(target for target, _ in payouts)
+            }
+            futures = [
+                executor.submit(self._payout, target, amount_msat, documents[target], pay)
+                for target, amount_msat in payouts
+            ]
+            return [future.result() for future in futures]
+
+    def _payout(self, target, amount_msat, document, pay):
+        result = {"target": target, "amount_msat": amount_msat}
+        try:
+            invoice = self.request_invoice(document.result(), amount_msat)
+            result.update(status="paid", result=pay(invoice))
+        except Exception as e:
+            logger.error(f"Payout to {target} failed: {e}")
+            result.update(status="failed", error=str(e))
+        PAYOUTS.inc(status=result["status"])
+        return result
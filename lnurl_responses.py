@@ -0,0 +1,64 @@
+import hashlib
+import json
+import threading
+from collections import namedtuple
+
+# Document with its serialized body and validator, built once and served as is
+CachedResponse = namedtuple("CachedResponse", ["document", "body", "etag"])
+
+
+def make_cached_response(document):
+    body = json.dumps(document, separators=(",", ":")).encode()
+    return CachedResponse(document, body, hashlib.sha256(body).hexdigest()[:32])
+
+
+def pay_metadata(text, identifier=None):
+    """LUD-06 metadata string, with a LUD-16 identifier for lightning addresses."""
+    entries = [["text/plain", text]]
+    if identifier:
+        entries.append(["text/identifier", identifier])
+    return json.dumps(entries)
+
+
+class LnurlResponseCache:
+    """Build LNURL documents on first use and keep them until invalidated.
+
+    `builders` maps a key to a function returning the document (a dict) for
+    that key. `invalidate()` drops everything, e.g. after the node announced
+    new addresses or the configuration was reloaded; the next request
+    rebuilds from the current state.
+    """
+
+    def __init__(self, builders):
+        self.builders = builders
+        self._responses = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def __contains__(self, key):
+        return key in self.builders
+
+    def get(self, key):
+        response = self._responses.get(key)
+        if response is None:
+            generation = self._generation
+            response = make_cached_response(self.builders[key]())
+            with self._lock:
+                # Don't keep a document built from state invalidated meanwhile
+                if generation == self._generation:
+                    self._responses[key] = response
+                self.builds += 1
+        return response
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._responses = {}
+
+    def set_builders(self, builders):
+        """Replace the builders (new configuration) and drop cached documents."""
+        with self._lock:
+            self.builders = builders
+            self._generation += 1
+            self._responses = {}
@@ -1,65 +1,224 @@
-from flask import Flask, jsonify, request
-from pyln.client import LightningRpc
+from flask import Flask, Response, jsonify, request
 from hashlib import sha256
+import atexit
+import functools
+import ipaddress
 import logging
 import os
+import re
 from datetime import datetime
 import uuid
 import json
 import secrets
-import sqlite3
+import signal
+import socket
+import time
 from dotenv import load_dotenv
+from channel_sessions import ChannelOpener, MemorySessionStore, SqliteSessionStore
+from invoice_pool import InvoicePool
+from lnurl_responses import LnurlResponseCache, pay_metadata
+from logging_setup import setup_logging
+from maintenance import MaintenanceSweeper
+from merchant_nodes import MerchantNode, parse_merchant_nodes, pick_node
+from metrics import Counter, Gauge, instrument_flask
+from payments import QueueFull
+from pricing import FileRateSource, HttpRateSource, PriceEngine, PriceUnavailable, StaticRateSource, parse_rounding
+from ratelimit import (REJECTED, ConcurrencyLimiter, MemoryBackend, RateLimiter, SqliteBackend,
+                       parse_bucket, retry_after_header)
+from redemption import CodeIndex
+from settlement import SettlementWatcher
+from storage import Storage
 
 load_dotenv()
 
 app = Flask(__name__)
 
+setup_logging()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('app.log')
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+instrument_flask(app)
+
+INVOICES_CREATED = Counter("gift_card_invoices_created_total", "Gift card invoices handed out", ["denomination", "source"])
+CHECKOUTS_WAITING = Gauge("gift_card_checkouts_waiting", "Long-poll requests waiting for a payment")
+INVOICE_POOL_DEPTH = Gauge("invoice_pool_depth", "Ready invoices in the pool", ["denomination"])
+INVOICE_POOL_REFILL_LAG = Gauge("invoice_pool_refill_lag_seconds",
+                                "Seconds the last refill took to bring the pool back to its target depth",
+                                ["denomination"])
 
 # Core Lightning node configuration
 LIGHTNING_RPC_PATH = os.getenv('LIGHTNING_RPC_PATH')
 METADATA_PLAIN = "Payment for services"
 METADATA = f"""[["text/plain","{METADATA_PLAIN}"]]"""
+METADATA_HASH = sha256(METADATA.encode('utf-8')).hexdigest()
+
+# LNURL-pay limits in fiat, converted to msat at the current exchange rate
+MIN_SENDABLE_FIAT = os.getenv('LNURL_MIN_SENDABLE_EUR', '0.001')
+MAX_SENDABLE_FIAT = os.getenv('LNURL_MAX_SENDABLE_EUR', '1')
+
+# Lightning addresses (LUD-16) served under /.well-known/lnurlp/<username>.
+# A JSON file named after the username in LNURLP_DIR replaces the generated document.
+LNURLP_USERNAMES = [u.strip() for u in os.getenv('LNURLP_USERNAMES', 'sosthene').split(',') if u.strip()]
+LNURLP_DIR = os.getenv('LNURLP_DIR')
+LNURL_DOMAIN = os.getenv('LNURL_DOMAIN', 'localhost:5000')
+# How long clients may reuse the static LNURL documents (seconds)
+LNURL_CACHE_MAX_AGE = int(os.getenv('LNURL_CACHE_MAX_AGE', '300'))
 
 MERCHANT_NODE_ID = os.getenv('MERCHANT_NODE_ID')
 
+# Gift card nodes as "node_id@rpc_path,..."; the first one also serves the LNURL
+# endpoints. Defaults to the single node MERCHANT_NODE_ID / LIGHTNING_RPC_PATH.
+MERCHANT_NODES = parse_merchant_nodes(os.getenv('MERCHANT_NODES', '')) or [(MERCHANT_NODE_ID, LIGHTNING_RPC_PATH)]
+MERCHANT_NODE_ID, LIGHTNING_RPC_PATH = MERCHANT_NODES[0]
+
+merchant_nodes = [
+    MerchantNode(
+        node_id,
+        rpc_path,
+        rpc_pool_size=int(os.getenv('RPC_POOL_SIZE', '8')),
+        refresh_interval=int(os.getenv('NODE_STATE_REFRESH', '30')),
+        # A new address announced by the LNURL node changes the /lnurl2 response
+        on_identity_change=(lambda snapshot: lnurl_cache.invalidate()) if i == 0 else None
+    )
+    for i, (node_id, rpc_path) in enumerate(MERCHANT_NODES)
+]
+rpc_pool = merchant_nodes[0].rpc_pool
+node_state = merchant_nodes[0].state
+
 def get_client():
-    logger.info("Getting an instance of the LightningRpc client...")
-    """Get an instance of the LightningRpc client."""
+    """Get the pooled LightningRpc client shared by all requests."""
+    return rpc_pool.client
+
+# Base de données pour les cartes cadeaux
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'gift_cards.db')
+storage = Storage(DATABASE_PATH, pool_size=int(os.getenv('DATABASE_POOL_SIZE', '8')))
+
+# Identifiant de ce processus pour les baux partagés (watcher de règlement, maintenance, canaux)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+def init_db():
+    storage.migrate()
+
+# Limitation de débit, "débit par seconde,rafale" par client et global (vide = désactivé).
+# Le backend sqlite partage les compteurs entre les processus.
+RATE_LIMITS = {
+    "create_invoice": (
+        parse_bucket(os.getenv('RATE_LIMIT_CREATE_PER_CLIENT', '0.2,5')),
+        parse_bucket(os.getenv('RATE_LIMIT_CREATE_GLOBAL', '20,50'))
+    ),
+    "poll": (
+        parse_bucket(os.getenv('RATE_LIMIT_POLL_PER_CLIENT', '5,20')),
+        parse_bucket(os.getenv('RATE_LIMIT_POLL_GLOBAL', ''))
+    ),
+    "redeem": (
+        parse_bucket(os.getenv('RATE_LIMIT_REDEEM_PER_CLIENT', '20,100')),
+        parse_bucket(os.getenv('RATE_LIMIT_REDEEM_GLOBAL', ''))
+    ),
+    "channel": (
+        parse_bucket(os.getenv('RATE_LIMIT_CHANNEL_PER_CLIENT', '0.1,5')),
+        parse_bucket(os.getenv('RATE_LIMIT_CHANNEL_GLOBAL', '1,20'))
+    ),
+}
+rate_limiter = RateLimiter(
+    SqliteBackend(storage) if os.getenv('RATE_LIMIT_BACKEND', 'memory') == 'sqlite' else MemoryBackend(),
+    RATE_LIMITS
+)
+# Requêtes appelant le nœud en même temps ; au-delà, 503 immédiat plutôt qu'une file d'attente
+rpc_slots = ConcurrencyLimiter(int(os.getenv('MAX_RPC_IN_FLIGHT', '16')))
+# Proxys (adresses ou réseaux) dont on lit X-Forwarded-For : le proxy client
+# (lnurl_client.py) transmet l'adresse de l'acheteur
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if item.strip()
+]
+
+def is_trusted_proxy(address):
     try:
-        return LightningRpc(LIGHTNING_RPC_PATH)
-    except Exception as e:
-        logger.error(f"Error connecting to LightningRpc: {e}")
-        raise
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
 
-def get_node_connect_info():
-    logger.info("Getting the node's connection info...")
-    """Get the node's connection info."""
-    node = get_client()
-    node_info = node.getinfo()
-    first_address = node_info['address'][0]
-    return f"{node_info['id']}@{first_address['address']}:{first_address['port']}"
+def client_address(remote_addr, forwarded_for=None):
+    """Adresse du client pour la limitation de débit.
 
-def get_random_id():
-    logger.info("Generating a random k1 identifier...")
-    """Generate a random k1 identifier."""
-    return os.urandom(12).hex()
+    X-Forwarded-For n'est lu que si la requête vient d'un proxy de confiance ;
+    on remonte alors les sauts de droite à gauche jusqu'au premier qui n'est pas
+    un proxy de confiance, les valeurs plus à gauche pouvant être forgées par le client.
+    """
+    address = remote_addr or "unknown"
+    if not forwarded_for or not is_trusted_proxy(address):
+        return address
+    for hop in reversed([hop.strip() for hop in forwarded_for.split(',') if hop.strip()]):
+        address = hop
+        if not is_trusted_proxy(hop):
+            break
+    return address
+
+def admit(scope, client, rpc_bound=False):
+    """Contrôle d'admission : None si la requête passe, sinon (message, code HTTP, en-têtes).
+
+    Avec `rpc_bound`, la requête prend une place de rpc_slots que l'appelant
+    doit rendre avec rpc_slots.release().
+    """
+    wait = rate_limiter.check(scope, client)
+    if wait:
+        return "Trop de requêtes, réessayez plus tard", 429, {"Retry-After": retry_after_header(wait)}
+    if rpc_bound and not rpc_slots.try_acquire():
+        REJECTED.inc(scope=scope, reason="concurrency")
+        return "Serveur occupé, réessayez dans un instant", 503, {"Retry-After": "1"}
+    return None
+
+def limited(scope, rpc_bound=False, error_body=lambda message: {"error": message}):
+    """Appliquer admit() à une route Flask."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            client = client_address(request.remote_addr, request.headers.get('X-Forwarded-For'))
+            rejected = admit(scope, client, rpc_bound)
+            if rejected:
+                message, status, headers = rejected
+                return jsonify(error_body(message)), status, headers
+            try:
+                return view(*args, **kwargs)
+            finally:
+                if rpc_bound:
+                    rpc_slots.release()
+        return wrapper
+    return decorator
+
+# LNURL-channel: each k1 is single-use and expires; channel opens run in the background.
+# With several worker processes, CHANNEL_SESSION_BACKEND=sqlite shares the sessions
+# (the default under gunicorn.conf.py).
+CHANNEL_K1_TTL = int(os.getenv('CHANNEL_K1_TTL', '600'))
+CHANNEL_MAX_AMOUNT = int(os.getenv('LNURL_CHANNEL_MAX_AMOUNT', '16777215'))  # sats
+NODE_ID_PATTERN = re.compile(r"^0[23][0-9a-f]{64}$")
+
+channel_sessions = (
+    SqliteSessionStore(storage, ttl=CHANNEL_K1_TTL)
+    if os.getenv('CHANNEL_SESSION_BACKEND', 'memory') == 'sqlite'
+    else MemorySessionStore(ttl=CHANNEL_K1_TTL)
+)
+CHANNEL_OPEN_WORKERS = int(os.getenv('CHANNEL_OPEN_WORKERS', '1'))
+channel_opener = ChannelOpener(
+    lambda session: get_client().fundchannel(
+        node_id=session["remote_id"], amount=session["amount"], announce=not session["private"]
+    ),
+    channel_sessions,
+    workers=CHANNEL_OPEN_WORKERS,
+    max_queued=int(os.getenv('CHANNEL_OPEN_QUEUE', '10')),
+    # One open at a time across every worker process, not only within this one
+    storage=storage,
+    lease="fundchannel" if CHANNEL_OPEN_WORKERS == 1 else None,
+    holder=WORKER_ID
+)
 
 def get_callback(tag):
-    logger.info("Generating callback URLs...")
     """Generate callback URLs."""
     if tag == "channelRequest":
         return f"lnurl-channel-request"
     elif tag == "payRequest":
         return f"lnurl-pay"
 
-def generate_invoice(amount):
-    logger.info(f"Generating an invoice for {amount} millisatoshis...")
+def generate_invoice(amount, metadata_hash=METADATA_HASH):
     """Generate a real invoice from the Core Lightning node."""
     node = get_client()
     try:
@@ -67,233 +226,654 @@ def generate_invoice(amount):
         timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
         unique_id = uuid.uuid4().hex[:8]  # Short unique ID
         label = f"invoice_{timestamp}_{unique_id}"
-        invoice = node.invoice(amount, f"{label}", f"{sha256(METADATA.encode("utf-8")).hexdigest()}")
-        logger.info(f"Generated invoice: {invoice}")
+        invoice = node.invoice(amount, f"{label}", metadata_hash)
+        logger.info("Generated invoice", extra={
+            "sample": "lnurl_pay", "amount_msat": amount, "payment_hash": invoice['payment_hash']
+        })
         return invoice
     except Exception as e:
-        logger.error(f"Error generating invoice: {e}")
+        logger.error("Error generating invoice", extra={"amount_msat": amount, "error": str(e)})
         return None
 
 @app.route("/lnurl-channel-request", methods=["GET"])
+@limited("channel", error_body=lambda message: {"status": "ERROR", "reason": message})
 def answer_channel_request():
-    logger.info("Handling channel requests...")
-    """Handle channel requests."""
-    k1 = request.args.get("k1")
-    remote_id = request.args.get("remote_id")
-    announce = False if request.args.get("private")==1 else True
-    amount = int(request.args.get("amount"))
+    """Handle channel requests: claim the k1 and queue the channel open."""
+    k1 = request.args.get("k1", "")
+    if request.args.get("cancel") == "1":
+        channel_sessions.cancel(k1)
+        return jsonify({"status": "OK"})
+    remote_id = request.args.get("remote_id", "")
+    if not NODE_ID_PATTERN.match(remote_id):
+        return jsonify({"status": "ERROR", "reason": "Invalid remote_id"}), 400
     try:
-        client = get_client()
-        res = client.fundchannel(node_id=remote_id, amount=amount, announce=announce) 
-        return jsonify({"status": "OK", "result": res})
+        amount = int(request.args.get("amount"))
+    except (TypeError, ValueError):
+        return jsonify({"status": "ERROR", "reason": "Invalid amount"}), 400
+    if not 0 < amount <= CHANNEL_MAX_AMOUNT:
+        return jsonify({"status": "ERROR", "reason": f"Amount must be between 1 and {CHANNEL_MAX_AMOUNT} sat"}), 400
+    private = request.args.get("private") == "1"
+    try:
+        if not channel_sessions.claim(k1, remote_id, amount, private):
+            return jsonify({"status": "ERROR", "reason": "Invalid, expired or already used k1"}), 400
+        try:
+            channel_opener.submit(k1)
+        except QueueFull:
+            # Give the k1 back so the wallet can retry
+            channel_sessions.update(k1, "issued")
+            return jsonify({"status": "ERROR", "reason": "Too many channel opens in progress"}), 503
+        return jsonify({"status": "OK", "status_url": f"lnurl-channel-status/{k1}"})
     except Exception as e:
+        logger.error("Error in lnurl-channel-request", extra={"error": str(e)})
         return jsonify({"status": "ERROR", "reason": str(e)}), 500
 
+@app.route("/lnurl-channel-status/<k1>", methods=["GET"])
+def channel_request_status(k1):
+    """Progress of the channel open requested with `k1`."""
+    session = channel_sessions.get(k1)
+    if session is None:
+        return jsonify({"status": "ERROR", "reason": "Unknown k1"}), 404
+    return jsonify({
+        "status": "OK",
+        "state": session["status"],
+        "remote_id": session["remote_id"],
+        "amount": session["amount"],
+        "private": session["private"],
+        "result": session["result"],
+        "error": session["error"],
+    })
+
+def load_lightning_addresses():
+    """Build the payRequest document of every configured username, once."""
+    addresses = {}
+    for username in LNURLP_USERNAMES:
+        path = os.path.join(LNURLP_DIR, username) if LNURLP_DIR else None
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                document = json.load(f)
+        else:
+            document = {
+                "callback": f"{get_callback('payRequest')}/{username}",
+                "metadata": pay_metadata(f"Payment to {username}", f"{username}@{LNURL_DOMAIN}"),
+                "tag": "payRequest",
+            }
+        addresses[username] = {
+            "document": document,
+            "metadata_hash": sha256(document["metadata"].encode('utf-8')).hexdigest(),
+        }
+    return addresses
+
+def channel_request_document():
+    """Static part of the channelRequest response; k1 is added per request."""
+    snapshot = node_state.snapshot
+    if snapshot is None or not snapshot.addresses:
+        raise RuntimeError("Node address unavailable")
+    first_address = snapshot.addresses[0]
+    return {
+        "status": "OK",
+        "tag": "channelRequest",
+        "uri": f"{snapshot.node_id}@{first_address['address']}:{first_address['port']}",
+        "callback": get_callback("channelRequest"),
+    }
+
+def sendable_range():
+    """LNURL-pay limits in msat at the cached exchange rate; the cache is invalidated when it changes."""
+    return {
+        "maxSendable": prices.fiat_to_msat(MAX_SENDABLE_FIAT),
+        "minSendable": prices.fiat_to_msat(MIN_SENDABLE_FIAT),
+    }
+
+def lnurl_builders(addresses):
+    builders = {
+        "payRequest": lambda: dict(sendable_range(), **{
+            "callback": get_callback("payRequest"),
+            "metadata": METADATA,
+            "tag": "payRequest",
+        }),
+        "channelRequest": channel_request_document,
+    }
+    for username, address in addresses.items():
+        # Documents from LNURLP_DIR may set their own limits
+        builders[f"lnurlp/{username}"] = lambda document=address["document"]: dict(sendable_range(), **document)
+    return builders
+
+lightning_addresses = load_lightning_addresses()
+lnurl_cache = LnurlResponseCache(lnurl_builders(lightning_addresses))
+
+def reload_lnurl_config():
+    """Re-read the lightning address documents and drop the cached responses."""
+    global lightning_addresses
+    lightning_addresses = load_lightning_addresses()
+    lnurl_cache.set_builders(lnurl_builders(lightning_addresses))
+    logger.info("LNURL configuration reloaded", extra={"usernames": list(lightning_addresses)})
+
+def cached_lnurl_response(key):
+    """Serve a cached LNURL document with ETag/Cache-Control."""
+    cached = lnurl_cache.get(key)
+    response = Response(cached.body, mimetype="application/json")
+    response.headers["Cache-Control"] = f"public, max-age={LNURL_CACHE_MAX_AGE}"
+    response.set_etag(cached.etag)
+    return response.make_conditional(request)
+
 @app.route("/lnurl2", methods=["GET"])
+@limited("channel", error_body=lambda message: {"status": "ERROR", "reason": message})
 def lnurl_channel():
-    logger.info("Handling LNURL2 requests...")
     """LNURL-channel endpoint to open channel to client."""
     try:
-        tag = "channelRequest"
-        node_info = get_node_connect_info()
-        logger.info(f"Node info: {node_info}")
-        k1 = get_random_id()
-        logger.info(f"Generated k1: {k1}")
-        callback = get_callback(tag)
-        logger.info(f"Callback URL: {callback}")
-        return jsonify({
-            "status": "OK",
-            "tag": tag,
-            "uri": node_info,
-            "k1": k1,
-            "callback": callback,
-        })
+        # k1 is single-use, so only the node part of the response is cached
+        response = jsonify(dict(lnurl_cache.get("channelRequest").document, k1=channel_sessions.issue()))
+        response.headers["Cache-Control"] = "no-store"
+        return response
     except Exception as e:
-        logger.error(f"Error in lnurl2: {e}")
+        logger.error("Error in lnurl2", extra={"error": str(e)})
         return jsonify({"status": "ERROR", "reason": str(e)}), 500
 
 @app.route("/lnurl-pay", methods=["GET"])
-def lnurl_answer_pay():
-    logger.info("Handling LNURL-pay requests...")
+@app.route("/lnurl-pay/<username>", methods=["GET"])
+@limited("create_invoice", rpc_bound=True, error_body=lambda message: {"status": "ERROR", "reason": message})
+def lnurl_answer_pay(username=None):
     """LNURL-pay endpoint to generate invoices."""
+    if username is not None and username not in lightning_addresses:
+        return jsonify({"status": "ERROR", "reason": "Unknown user"}), 404
     try:
         amount = int(request.args.get("amount"))  # Amount in millisatoshis
-        invoice = generate_invoice(amount)
+        metadata_hash = lightning_addresses[username]["metadata_hash"] if username else METADATA_HASH
+        invoice = generate_invoice(amount, metadata_hash)
         bolt11 = invoice['bolt11']
-        # logger.info(f"Generated invoice: {invoice}")
         return jsonify({
             "pr": f"{bolt11}",
             "routes": [],
         })
     except Exception as e:
-        logger.error(f"Error in lnurl-pay: {e}")
+        logger.error("Error in lnurl-pay", extra={"error": str(e)})
         return jsonify({"status": "ERROR", "reason": f"{e}"}), 500
     
 @app.route("/lnurl6", methods=["GET"])
 def lnurl_pay():
-    logger.info("Handling LNURL3 requests...")
     """LNURL3 endpoint to pay invoices."""
     try:
-        tag = "payRequest"
-        callback = get_callback(tag)
-        max_sendable = 1_000_000
-        min_sendable = 1_000
-        return jsonify({
-            "callback": callback,
-            "maxSendable": max_sendable,
-            "minSendable": min_sendable,
-            "metadata": METADATA,
-            "tag": tag,
-        })
+        return cached_lnurl_response("payRequest")
     except Exception as e:
         return jsonify({"status": "ERROR", "reason": str(e)}), 500
     
-@app.route("/.well-known/lnurlp/sosthene", methods=["GET"])
-def lnurlp():
-    logger.info("Handling LNURLp requests...")
+@app.route("/.well-known/lnurlp/<username>", methods=["GET"])
+def lnurlp(username):
     """LNURLp endpoint to pay invoices."""
+    if f"lnurlp/{username}" not in lnurl_cache:
+        return jsonify({"status": "ERROR", "reason": "Unknown user"}), 404
     try:
-        with open("/home/aespieux/.well-known/lnurlp/sosthene", "r") as f:
-            return jsonify(f.read()), 200
+        return cached_lnurl_response(f"lnurlp/{username}")
     except Exception as e:
         return jsonify({"status": "ERROR", "reason": str(e)}), 500
 
-# Base de données pour les cartes cadeaux
-def init_db():
-    conn = sqlite3.connect('gift_cards.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS gift_cards
-        (id TEXT PRIMARY KEY, 
-         amount INTEGER,
-         payment_hash TEXT,
-         code TEXT,
-         status TEXT,
-         created_at TIMESTAMP)
-    ''')
-    conn.commit()
-    conn.close()
-
-# Prix en satoshis (1 EUR ≈ 1000 sats pour l'exemple)
-PRICES = {
-    "25": 25000,  # 25 EUR
-    "50": 50000,  # 50 EUR
-    "100": 100000 # 100 EUR
-}
+# Valeurs des cartes en EUR, vendues au taux de change courant
+DENOMINATIONS = ("25", "50", "100")
+
+def rate_source():
+    """Source du taux EUR/BTC : static (RATE_STATIC), file (RATE_FILE) ou http (RATE_URL, RATE_URL_FIELD)."""
+    kind = os.getenv('RATE_SOURCE', 'static')
+    if kind == 'file':
+        return FileRateSource(os.getenv('RATE_FILE', 'rate.json'))
+    if kind == 'http':
+        return HttpRateSource(
+            os.getenv('RATE_URL', 'https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=eur'),
+            os.getenv('RATE_URL_FIELD', 'bitcoin.eur')
+        )
+    # 100 000 EUR/BTC : 1 EUR = 1000 sats, l'ancien prix fixe
+    return StaticRateSource(os.getenv('RATE_STATIC', '100000'))
+
+def on_rate_change(snapshot):
+    # Les documents LNURL-pay portent les limites en msat, les factures pré-générées un montant
+    lnurl_cache.invalidate()
+    invoice_pool.refresh_soon()
+    logger.info("Taux de change mis à jour", extra={"rate": float(snapshot.rate), "prices_msat": snapshot.prices})
+
+# Taux rafraîchi en tâche de fond ; les requêtes lisent le dernier taux connu, jamais la source
+prices = PriceEngine(
+    rate_source(),
+    DENOMINATIONS,
+    refresh_interval=int(os.getenv('RATE_REFRESH_INTERVAL', '60')),
+    max_age=int(os.getenv('RATE_MAX_AGE', '600')),
+    rounding=parse_rounding(os.getenv('PRICE_ROUNDING', '')),
+    on_change=on_rate_change
+)
+
+# Durée de validité des factures de cartes cadeaux (secondes)
+INVOICE_EXPIRY = int(os.getenv('INVOICE_EXPIRY', '3600'))
+# Nombre de factures pré-générées par montant (0 = pool désactivé)
+INVOICE_POOL_SIZE = int(os.getenv('INVOICE_POOL_SIZE', '0'))
+
+def invoice_params(amount, label):
+    """Paramètres de l'appel RPC `invoice` pour une carte cadeau."""
+    return {
+        "amount_msat": prices.price_msat(amount),
+        "label": label,
+        "description": f"Carte cadeau {amount}€",
+        "expiry": INVOICE_EXPIRY
+    }
+
+def create_node_invoice(amount, label, node=None):
+    """Créer la facture d'une carte cadeau sur le nœud (le premier par défaut)."""
+    params = invoice_params(amount, label)
+    invoice = (node or merchant_nodes[0]).get_client().invoice(**params)
+    return dict(invoice, amount_msat=params["amount_msat"])
+
+invoice_pool = InvoicePool(
+    create_node_invoice,
+    DENOMINATIONS,
+    INVOICE_POOL_SIZE,
+    delete=lambda label: get_client().delinvoice(label=label, status="unpaid"),
+    # Les factures trop loin du prix courant sont retirées après un changement de taux
+    price=prices.price_msat,
+    price_tolerance=float(os.getenv('INVOICE_POOL_PRICE_TOLERANCE', '0.005'))
+)
+
+INVOICE_POOL_DEPTH.set_function(
+    lambda: {(amount,): m["depth"] for amount, m in invoice_pool.metrics().items()}
+)
+INVOICE_POOL_REFILL_LAG.set_function(
+    lambda: {(amount,): m["refill_lag_seconds"] for amount, m in invoice_pool.metrics().items()}
+)
+
+def on_node_settled(node, invoice):
+    # Les codes émis sont reconnus tout de suite par ce processus, sans attendre la synchronisation
+    code_index.add(code for _, status, code in storage.get_payment(invoice['payment_hash']) if status == 'completed')
+    # Un règlement modifie la liquidité locale : rafraîchir l'instantané
+    node.state.refresh_soon()
+    # Les requêtes en attente sont abonnées au watcher du premier nœud
+    if node.watcher is not settlement_watcher:
+        settlement_watcher.notify(invoice['payment_hash'])
+
+for i, node in enumerate(merchant_nodes):
+    # Un seul processus surveille chaque nœud ; le premier garde la clé pay_index historique
+    node.watcher = SettlementWatcher(
+        node.get_client,
+        storage,
+        on_settled=lambda invoice, node=node: on_node_settled(node, invoice),
+        state_key="pay_index" if i == 0 else f"pay_index:{node.node_id}",
+        lease=f"settlement:{node.node_id}",
+        holder=WORKER_ID
+    )
+settlement_watcher = merchant_nodes[0].watcher
+
+# Nettoyage périodique : factures expirées (base et nœuds), archivage des anciennes cartes
+maintenance = MaintenanceSweeper(
+    storage,
+    [(node.node_id, node.get_client) for node in merchant_nodes],
+    interval=int(os.getenv('MAINTENANCE_INTERVAL', '300')),
+    grace=int(os.getenv('INVOICE_EXPIRY_GRACE', '600')),
+    retention_days=int(os.getenv('RETENTION_DAYS', '90')),
+    lease="maintenance",
+    holder=WORKER_ID
+)
+
+def check_node_ready(node, amount_msat):
+    """Vérifier le nœud et sa liquidité sur l'instantané en cache (aucun appel RPC).
+
+    Retourne (message d'erreur, code HTTP) si la facture ne peut pas être créée.
+    """
+    snapshot = node.state.snapshot
+    if snapshot is None:
+        logger.warning("État du nœud indisponible", extra={"node_id": node.node_id})
+        return "État du nœud indisponible", 503
+
+    if snapshot.node_id != node.node_id:
+        logger.error("Mauvais nœud", extra={"expected": node.node_id, "actual": snapshot.node_id})
+        return "Configuration incorrecte du nœud", 500
+
+    # Vérifier que le nœud a des canaux actifs
+    if not snapshot.active_channels:
+        logger.warning("Aucun canal actif trouvé", extra={"node_id": node.node_id})
+        return "Aucun canal actif disponible", 500
+
+    if snapshot.inbound_msat < amount_msat:
+        logger.warning("Liquidité entrante insuffisante", extra={
+            "node_id": node.node_id, "inbound_msat": snapshot.inbound_msat, "amount_msat": amount_msat
+        })
+        return "Liquidité entrante insuffisante", 503
+    return None
+
+def select_node(amount_msat):
+    """Choisir un nœud marchand prêt à recevoir `amount_msat`, selon sa liquidité entrante.
+
+    Retourne (nœud, None), ou (None, (message d'erreur, code HTTP)) si aucun ne l'est.
+    """
+    ready, errors = [], []
+    for node in merchant_nodes:
+        error = check_node_ready(node, amount_msat)
+        if error:
+            errors.append(error)
+        else:
+            ready.append(node)
+    if ready:
+        return pick_node(ready), None
+    if len(errors) == 1:
+        return None, errors[0]
+    return None, ("Aucun nœud marchand disponible", 503)
+
+def take_pooled_invoice(amount, node):
+    """Prendre une facture pré-générée pour ce montant, si le pool en a une.
+
+    Le pool est alimenté par le premier nœud uniquement.
+    """
+    pooled = invoice_pool.take(amount) if INVOICE_POOL_SIZE and node is merchant_nodes[0] else None
+    return pooled._asdict() if pooled is not None else None
+
+def save_invoice(amount, invoice, source, node):
+    """Enregistrer la carte en attente de paiement et préparer la réponse.
+
+    `source` vaut "pool" pour une facture pré-générée, "node" sinon.
+    """
+    # Sauvegarder dans la base de données
+    storage.insert_gift_card(
+        invoice['label'], amount, invoice['payment_hash'], node.node_id, invoice.get('expires_at')
+    )
+    INVOICES_CREATED.inc(denomination=amount, source=source)
+    logger.info("Facture créée", extra={
+        "sample": "create_invoice", "amount": amount, "payment_hash": invoice['payment_hash']
+    })
+    
+    return {
+        "payment_request": invoice['bolt11'],
+        "payment_hash": invoice['payment_hash']
+    }
 
 @app.route('/api/create_invoice/<amount>', methods=['GET'])
+@limited("create_invoice", rpc_bound=True)
 def create_invoice(amount):
-    print(f"Tentative de création d'une facture pour {amount}€")  # Log
-    
-    if amount not in PRICES:
-        print(f"Montant invalide: {amount}")  # Log
+    if amount not in DENOMINATIONS:
+        logger.info("Montant invalide", extra={"amount": amount})
         return jsonify({"error": "Montant invalide"}), 400
     
-    sats_amount = PRICES[amount]
     label = f"giftcard_{secrets.token_hex(8)}"
     
     try:
-        # Vérifier que nous utilisons le bon nœud
-        client = get_client()
-        print("Client Lightning connecté")  # Log
-        
-        node_info = client.getinfo()
-        print(f"ID du nœud: {node_info['id']}")  # Log
-        
-        if node_info['id'] != MERCHANT_NODE_ID:
-            print(f"Mauvais nœud: attendu {MERCHANT_NODE_ID}, reçu {node_info['id']}")  # Log
-            return jsonify({"error": "Configuration incorrecte du nœud"}), 500
-
-        # Vérifier que le nœud a des canaux actifs
-        channels = client.listchannels()['channels']
-        active_channels = [c for c in channels if c['active'] and c['source'] == MERCHANT_NODE_ID]
-        print(f"Nombre de canaux actifs: {len(active_channels)}")  # Log
+        node, error = select_node(prices.price_msat(amount))
+        if error:
+            return jsonify({"error": error[0]}), error[1]
+
+        # Prendre une facture pré-générée si possible, sinon la créer
+        invoice, source = take_pooled_invoice(amount, node), "pool"
+        if invoice is None:
+            invoice, source = dict(create_node_invoice(amount, label, node), label=label), "node"
         
-        if not active_channels:
-            print("Aucun canal actif trouvé")  # Log
-            return jsonify({"error": "Aucun canal actif disponible"}), 500
-
-        # Créer la facture
-        print(f"Création de la facture pour {sats_amount} sats")  # Log
-        invoice = client.invoice(
-            amount_msat=sats_amount * 1000,
+        return jsonify(save_invoice(amount, invoice, source, node))
+    except PriceUnavailable:
+        return jsonify({"error": "Taux de change indisponible"}), 503
+    except Exception as e:
+        logger.exception("Erreur lors de la création de la facture", extra={"amount": amount})
+        return jsonify({"error": f"Erreur lors de la création de la facture: {str(e)}"}), 500
+
+def payment_status(cards):
+    """Statut d'une facture à partir de ses cartes [(montant, statut, code), ...]."""
+    # Toutes les cartes d'une facture sont émises dans la même transaction
+    if cards and cards[0][1] == 'expired':
+        return {"paid": False, "expired": True}
+    if not cards or cards[0][1] != 'completed':
+        return {"paid": False}
+    if len(cards) == 1:
+        return {"paid": True, "gift_code": cards[0][2]}
+    return {
+        "paid": True,
+        "cards": [{"amount": amount, "gift_code": code} for amount, _, code in cards]
+    }
+
+def get_payment_status(payment_hash):
+    """Lire le statut d'un paiement et le code cadeau émis au règlement."""
+    # Le statut est tenu à jour par le SettlementWatcher : lecture locale, sans appel RPC
+    cards = storage.get_payment(payment_hash)
+    if cards and cards[0][1] == 'paid':
+        # Ligne marquée payée par une version précédente : émettre le code une seule fois
+        storage.settle([payment_hash])
+        cards = storage.get_payment(payment_hash)
+    return payment_status(cards)
+
+@app.route('/api/check_payment/<payment_hash>', methods=['GET'])
+@limited("poll")
+def check_payment(payment_hash):
+    try:
+        return jsonify(get_payment_status(payment_hash))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Taille maximale d'une commande groupée et d'une vérification groupée
+BATCH_MAX_CARDS = int(os.getenv('BATCH_MAX_CARDS', '100'))
+BULK_STATUS_MAX_HASHES = int(os.getenv('BULK_STATUS_MAX_HASHES', '100'))
+
+def parse_basket(items):
+    """Valider un panier {"25": 10, "50": 2} ; retourne (cartes, erreur)."""
+    if not isinstance(items, dict) or not items:
+        return None, "Panier invalide"
+    cards = []
+    for amount, quantity in items.items():
+        if amount not in DENOMINATIONS:
+            return None, f"Montant invalide : {amount}"
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return None, f"Quantité invalide pour {amount}"
+        # Vérifié avant de construire la liste : une quantité énorme ne doit rien allouer
+        if quantity > BATCH_MAX_CARDS - len(cards):
+            return None, f"Pas plus de {BATCH_MAX_CARDS} cartes par commande"
+        cards.extend([amount] * quantity)
+    return cards, None
+
+@app.route('/api/create_batch_invoice', methods=['POST'])
+@limited("create_invoice", rpc_bound=True)
+def create_batch_invoice():
+    """Une seule facture pour un panier de cartes, par exemple {"items": {"25": 10, "50": 2}}."""
+    cards, error = parse_basket((request.get_json(silent=True) or {}).get("items"))
+    if error:
+        return jsonify({"error": error}), 400
+
+    label = f"giftbatch_{secrets.token_hex(8)}"
+    try:
+        total_msat = sum(prices.price_msat(amount) for amount in cards)
+        total_sats = total_msat // 1000
+        node, error = select_node(total_msat)
+        if error:
+            return jsonify({"error": error[0]}), error[1]
+
+        invoice = node.get_client().invoice(
+            amount_msat=total_msat,
             label=label,
-            description=f"Carte cadeau {amount}€"
+            description=f"{len(cards)} cartes cadeaux",
+            expiry=INVOICE_EXPIRY
         )
-        
-        print(f"Facture créée: {invoice['bolt11']}")  # Log
-        
-        # Sauvegarder dans la base de données
-        conn = sqlite3.connect('gift_cards.db')
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO gift_cards (id, amount, payment_hash, status, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (label, amount, invoice['payment_hash'], 'pending', datetime.now()))
-        conn.commit()
-        conn.close()
-        print("Facture sauvegardée dans la base de données")  # Log
-        
+        # Toutes les cartes en une transaction ; le règlement les émet ensemble
+        storage.insert_gift_cards(
+            [(f"{label}_{i}", amount, invoice['payment_hash']) for i, amount in enumerate(cards)],
+            node.node_id,
+            invoice.get('expires_at')
+        )
+        for amount in set(cards):
+            INVOICES_CREATED.inc(cards.count(amount), denomination=amount, source="batch")
+        logger.info("Facture groupée créée", extra={
+            "cards": len(cards), "total_sats": total_sats, "payment_hash": invoice['payment_hash']
+        })
         return jsonify({
             "payment_request": invoice['bolt11'],
-            "payment_hash": invoice['payment_hash']
+            "payment_hash": invoice['payment_hash'],
+            "total_sats": total_sats,
+            "cards": len(cards)
         })
+    except PriceUnavailable:
+        return jsonify({"error": "Taux de change indisponible"}), 503
     except Exception as e:
-        print(f"Erreur détaillée lors de la création de la facture: {str(e)}")  # Log détaillé
-        print(f"Type d'erreur: {type(e)}")  # Log du type d'erreur
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")  # Log du traceback complet
+        logger.exception("Erreur lors de la création de la facture groupée", extra={"cards": len(cards)})
         return jsonify({"error": f"Erreur lors de la création de la facture: {str(e)}"}), 500
 
-@app.route('/api/check_payment/<payment_hash>', methods=['GET'])
-def check_payment(payment_hash):
+@app.route('/api/check_payments', methods=['POST'])
+@limited("poll")
+def check_payments():
+    """Statut de plusieurs factures en une requête : {"payment_hashes": [...]}."""
+    payment_hashes = (request.get_json(silent=True) or {}).get("payment_hashes")
+    if not isinstance(payment_hashes, list) or not all(isinstance(h, str) for h in payment_hashes):
+        return jsonify({"error": "Liste de payment_hash invalide"}), 400
+    if len(payment_hashes) > BULK_STATUS_MAX_HASHES:
+        return jsonify({"error": f"Pas plus de {BULK_STATUS_MAX_HASHES} factures par requête"}), 400
+    try:
+        payments = storage.get_payments(payment_hashes)
+        legacy = [h for h, cards in payments.items() if cards[0][1] == 'paid']
+        if legacy:
+            storage.settle(legacy)
+            payments.update(storage.get_payments(legacy))
+        return jsonify({
+            "payments": {h: payment_status(payments.get(h)) for h in payment_hashes}
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Durée maximale (en secondes) pendant laquelle une requête de long-poll reste ouverte
+WAIT_PAYMENT_MAX_TIMEOUT = 60
+WAIT_PAYMENT_DEFAULT_TIMEOUT = 25
+
+@app.route('/api/wait_payment/<payment_hash>', methods=['GET'])
+@limited("poll")
+def wait_payment(payment_hash):
+    """Long-poll : répond dès que la facture est réglée, ou à l'expiration du timeout."""
+    try:
+        timeout = float(request.args.get("timeout", WAIT_PAYMENT_DEFAULT_TIMEOUT))
+        timeout = max(0, min(timeout, WAIT_PAYMENT_MAX_TIMEOUT))
+        deadline = time.monotonic() + timeout
+        CHECKOUTS_WAITING.inc()
+        try:
+            while True:
+                status = get_payment_status(payment_hash)
+                remaining = deadline - time.monotonic()
+                if status["paid"] or remaining <= 0:
+                    return jsonify(status)
+                # Réveillé par le watcher au règlement ; la relecture périodique couvre
+                # les règlements observés par un autre processus
+                settlement_watcher.wait_for(payment_hash, min(remaining, 5))
+        finally:
+            CHECKOUTS_WAITING.dec()
+    except ValueError:
+        return jsonify({"error": "Timeout invalide"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Échange des cartes cadeaux en point de vente ; les codes absents de l'index sont
+# rejetés sans requête, l'index relit les codes émis ailleurs au plus toutes les
+# REDEEM_INDEX_SYNC_INTERVAL secondes
+code_index = CodeIndex(storage, sync_interval=float(os.getenv('REDEEM_INDEX_SYNC_INTERVAL', '1')))
+
+def parse_redemption():
+    """Corps d'un échange : {"amount": montant (optionnel), "redemption_id": identifiant (optionnel)}."""
+    body = request.get_json(silent=True) or {}
+    amount = body.get("amount")
+    if amount is not None and (not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0):
+        raise ValueError("Montant invalide")
+    redemption_id = body.get("redemption_id")
+    if redemption_id is not None and not isinstance(redemption_id, str):
+        raise ValueError("redemption_id invalide")
+    return amount, redemption_id
+
+@app.route('/api/gift_cards/<code>', methods=['GET'])
+@limited("redeem")
+def gift_card_balance(code):
+    """Solde d'une carte cadeau."""
     try:
-        # Vérifier le statut du paiement
-        invoices = get_client().listinvoices()['invoices']
-        for inv in invoices:
-            if inv['payment_hash'] == payment_hash:
-                if inv['status'] == 'paid':
-                    # Générer code carte cadeau
-                    gift_code = f"GIFT-{secrets.token_hex(8)}"
-                    
-                    # Mettre à jour la base de données
-                    conn = sqlite3.connect('gift_cards.db')
-                    c = conn.cursor()
-                    c.execute('''
-                        UPDATE gift_cards 
-                        SET status = ?, code = ?
-                        WHERE payment_hash = ?
-                    ''', ('completed', gift_code, payment_hash))
-                    conn.commit()
-                    conn.close()
-                    
-                    return jsonify({
-                        "paid": True,
-                        "gift_code": gift_code
-                    })
-                return jsonify({"paid": False})
-        return jsonify({"paid": False})
+        card = code_index.get(code)
+        if card is None:
+            return jsonify({"error": "Code inconnu"}), 404
+        amount, balance = card
+        return jsonify({"code": code, "amount": amount, "balance": balance})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/gift_cards/<code>/redeem', methods=['POST'])
+@limited("redeem")
+def redeem_gift_card(code):
+    """Débiter une carte : tout le solde, ou `amount` pour un paiement partiel.
+
+    Rejouer la même requête avec le même `redemption_id` ne débite pas deux fois.
+    """
+    try:
+        amount, redemption_id = parse_redemption()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        result = code_index.redeem(code, amount, redemption_id)
+        if result is None:
+            return jsonify({"error": "Code inconnu"}), 404
+        redeemed, balance = result
+        if not redeemed:
+            return jsonify({"error": "Solde insuffisant", "code": code, "balance": balance}), 409
+        return jsonify({"code": code, "redeemed": redeemed, "balance": balance})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/test_node', methods=['GET'])
 def test_node():
     try:
-        client = get_client()
-        node_info = client.getinfo()
-        channels = client.listchannels()['channels']
-        active_channels = [c for c in channels if c['active'] and c['source'] == MERCHANT_NODE_ID]
+        snapshot = node_state.snapshot or node_state.refresh()
         
         return jsonify({
-            "node_id": node_info['id'],
-            "is_merchant_node": node_info['id'] == MERCHANT_NODE_ID,
-            "active_channels": len(active_channels),
-            "total_channels": len(channels)
+            "node_id": snapshot.node_id,
+            "is_merchant_node": snapshot.node_id == MERCHANT_NODE_ID,
+            "active_channels": snapshot.active_channels,
+            "total_channels": snapshot.total_channels,
+            "inbound_msat": snapshot.inbound_msat,
+            "updated_at": snapshot.updated_at,
+            "merchant_nodes": [
+                {
+                    "node_id": node.node_id,
+                    "ready": node.state.snapshot is not None and node.state.snapshot.node_id == node.node_id,
+                    "inbound_msat": node.state.snapshot.inbound_msat if node.state.snapshot else 0,
+                    "settlement_leader": node.watcher.is_leader
+                }
+                for node in merchant_nodes
+            ]
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/prices', methods=['GET'])
+def get_prices():
+    """Prix courant de chaque carte et état du taux de change."""
+    status = prices.status()
+    if status["available"]:
+        status["prices_sats"] = {d: msat // 1000 for d, msat in status["prices_msat"].items()}
+    return jsonify(status)
+
+@app.route('/api/invoice_pool', methods=['GET'])
+def invoice_pool_metrics():
+    return jsonify(invoice_pool.metrics())
+
+@app.route('/api/rpc_stats', methods=['GET'])
+def rpc_stats():
+    return jsonify(rpc_pool.stats())
+
+_background_started = False
+
+def start_background_tasks():
+    """Migrer la base et démarrer les tâches de fond du serveur marchand (une fois par processus)."""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    init_db()
+    code_index.warm()
+    prices.start()
+    channel_opener.start()
+    for node in merchant_nodes:
+        node.state.start()
+        node.watcher.start()
+    if INVOICE_POOL_SIZE:
+        invoice_pool.start()
+    maintenance.start()
+    atexit.register(stop_background_tasks)
+
+def stop_background_tasks():
+    """Arrêter les tâches de fond et libérer les baux de règlement tenus par ce processus."""
+    for node in merchant_nodes:
+        node.state.stop()
+        node.watcher.stop()
+    invoice_pool.stop()
+    maintenance.stop()
+    prices.stop()
+
 if __name__ == "__main__":
     logger.info("Starting LNURL server...")
-    init_db()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_lnurl_config())
+    start_background_tasks()
     app.run(host="0.0.0.0", port=5000)  # Run locally on port 5000
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""Asyncio serving mode for the merchant server.
+
+Run with an ASGI server, e.g. `uvicorn lnurl_server_asgi:app --port 5000`.
+Invoice creation and payment status run on the event loop, so pending
+checkouts held open by /api/wait_payment cost a coroutine instead of a
+thread; every other route is served by the Flask app in lnurl_server.py.
+Storage calls (payment status, rate limit buckets, new invoices) may wait
+for a pooled connection or a write lock, so they run in worker threads,
+off the event loop.
+"""
+import asyncio
+import os
+import secrets
+import time
+
+import lnurl_server as server
+from asgi import AsgiApp, json_response
+from async_rpc import AsyncLightningRpc
+from ratelimit import SqliteBackend
+
+async_rpcs = {
+    node.node_id: AsyncLightningRpc(node.rpc_path, on_call=node.rpc_pool.record)
+    for node in server.merchant_nodes
+}
+
+app = AsgiApp(
+    server.app,
+    on_startup=server.start_background_tasks,
+    wsgi_threads=int(os.getenv("ASGI_WSGI_THREADS", "32")),
+)
+
+# In-memory buckets are checked inline; shared ones are SQLite writes
+SHARED_RATE_LIMITS = isinstance(server.rate_limiter.backend, SqliteBackend)
+
+
+async def admit(request, scope, rpc_bound=False):
+    """Admission control shared with the Flask routes; returns a rejection response or None."""
+    client = server.client_address(request.client, request.headers.get("x-forwarded-for"))
+    if SHARED_RATE_LIMITS:
+        rejected = await asyncio.to_thread(server.admit, scope, client, rpc_bound)
+    else:
+        rejected = server.admit(scope, client, rpc_bound)
+    if rejected:
+        message, status, headers = rejected
+        return json_response({"error": message}, status, headers)
+    return None
+
+
+@app.route("/api/create_invoice/<amount>")
+async def create_invoice(request, amount):
+    if amount not in server.DENOMINATIONS:
+        return json_response({"error": "Montant invalide"}, 400)
+
+    rejected = await admit(request, "create_invoice", rpc_bound=True)
+    if rejected:
+        return rejected
+    try:
+        return await _create_invoice(amount)
+    finally:
+        server.rpc_slots.release()
+
+
+async def _create_invoice(amount):
+    try:
+        node, error = server.select_node(server.prices.price_msat(amount))
+    except server.PriceUnavailable:
+        return json_response({"error": "Taux de change indisponible"}, 503)
+    if error:
+        return json_response({"error": error[0]}, error[1])
+
+    try:
+        invoice, source = await asyncio.to_thread(server.take_pooled_invoice, amount, node), "pool"
+        if invoice is None:
+            label = f"giftcard_{secrets.token_hex(8)}"
+            invoice = await async_rpcs[node.node_id].invoice(**server.invoice_params(amount, label))
+            invoice, source = dict(invoice, label=label), "node"
+        return json_response(await asyncio.to_thread(server.save_invoice, amount, invoice, source, node))
+    except Exception as e:
+        return json_response({"error": f"Erreur lors de la création de la facture: {str(e)}"}, 500)
+
+
+@app.route("/api/check_payment/<payment_hash>")
+async def check_payment(request, payment_hash):
+    rejected = await admit(request, "poll")
+    if rejected:
+        return rejected
+    return json_response(await asyncio.to_thread(server.get_payment_status, payment_hash))
+
+
+@app.route("/api/wait_payment/<payment_hash>")
+async def wait_payment(request, payment_hash):
+    rejected = await admit(request, "poll")
+    if rejected:
+        return rejected
+    try:
+        timeout = float(request.args.get("timeout", server.WAIT_PAYMENT_DEFAULT_TIMEOUT))
+    except ValueError:
+        return json_response({"error": "Timeout invalide"}, 400)
+    timeout = max(0, min(timeout, server.WAIT_PAYMENT_MAX_TIMEOUT))
+    deadline = time.monotonic() + timeout
+
+    loop = asyncio.get_running_loop()
+    settled = asyncio.Event()
+
+    def on_settled():
+        loop.call_soon_threadsafe(settled.set)
+
+    server.settlement_watcher.subscribe(payment_hash, on_settled)
+    server.CHECKOUTS_WAITING.inc()
+    try:
+        while True:
+            status = await asyncio.to_thread(server.get_payment_status, payment_hash)
+            remaining = deadline - time.monotonic()
+            if status["paid"] or remaining <= 0:
+                return json_response(status)
+            # Same periodic re-read as the threaded endpoint, for settlements
+            # observed by another process
+            try:
+                await asyncio.wait_for(settled.wait(), min(remaining, 5))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        server.CHECKOUTS_WAITING.dec()
+        server.settlement_watcher.unsubscribe(payment_hash, on_settled)
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pyln.client import RpcError
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_ROWS = Counter(
+    "gift_card_maintenance_rows_total", "Cards expired or archived by the maintenance sweep", ["action"]
+)
+
+
+class MaintenanceSweeper(threading.Thread):
+    """Keep the gift card table and the nodes' invoice lists small.
+
+    Every `interval` seconds: pending cards whose invoice expired more than
+    `grace` seconds ago are marked 'expired', each node drops its expired
+    unpaid invoices (`autoclean-once`, or `delexpiredinvoice` on nodes that
+    predate it), and completed or expired cards older than `retention_days`
+    move to the archive table. `nodes` is a list of (node_id, get_client).
+    With a `lease`, only one worker process sweeps at a time.
+    """
+
+    def __init__(self, storage, nodes, interval=300, grace=600, retention_days=90,
+                 lease=None, holder=None):
+        super().__init__(name="maintenance", daemon=True)
+        self.storage = storage
+        self.nodes = nodes
+        self.interval = interval
+        self.grace = grace
+        self.retention_days = retention_days
+        self.lease = lease
+        self.holder = holder
+        self.last_run = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def sweep(self):
+        now = time.time()
+        expired = self.storage.expire_pending(int(now - self.grace))
+        MAINTENANCE_ROWS.inc(expired, action="expired")
+
+        for node_id, get_client in self.nodes:
+            try:
+                self._clean_node(get_client(), now)
+            except Exception as e:
+                logger.error(f"Could not clean expired invoices on {node_id}: {e}")
+
+        archived = 0
+        if self.retention_days:
+            archived = self.storage.archive(datetime.now() - timedelta(days=self.retention_days))
+            MAINTENANCE_ROWS.inc(archived, action="archived")
+
+        self.last_run = {"at": now, "expired": expired, "archived": archived}
+        logger.info("Maintenance sweep done", extra=self.last_run)
+        return self.last_run
+
+    def _clean_node(self, client, now):
+        try:
+            client.call("autoclean-once", {"subsystem": "expiredinvoices", "age": self.grace})
+        except RpcError as e:
+            # autoclean-once only exists on Core Lightning >= 22.11
+            if e.error.get("code") != -32601:
+                raise
+            client.call("delexpiredinvoice", {"maxexpirytime": int(now - self.grace)})
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if self.lease and not self.storage.acquire_lease(self.lease, self.holder, 2 * self.interval):
+                    continue
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Maintenance sweep failed: {e}")
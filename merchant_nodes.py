@@ -0,0 +1,44 @@
+import random
+
+from node_state import NodeStateCache
+from rpc_pool import RpcPool
+
+
+def parse_merchant_nodes(value):
+    """Parse 'node_id@/path/to/rpc,node_id@/other/rpc' into [(node_id, rpc_path), ...]."""
+    nodes = []
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        node_id, sep, rpc_path = item.partition("@")
+        if not sep or not node_id or not rpc_path:
+            raise ValueError(f"Invalid merchant node '{item}', expected node_id@rpc_path")
+        nodes.append((node_id, rpc_path))
+    return nodes
+
+
+class MerchantNode:
+    """One Core Lightning node issuing gift card invoices.
+
+    Holds the node's RPC pool and its cached state; the settlement watcher
+    is attached by the caller.
+    """
+
+    def __init__(self, node_id, rpc_path, rpc_pool_size=8, refresh_interval=30, on_identity_change=None):
+        self.node_id = node_id
+        self.rpc_path = rpc_path
+        self.rpc_pool = RpcPool(rpc_path, size=rpc_pool_size)
+        self.state = NodeStateCache(
+            self.get_client, refresh_interval=refresh_interval, on_identity_change=on_identity_change
+        )
+        self.watcher = None
+
+    def get_client(self):
+        return self.rpc_pool.client
+
+
+def pick_node(candidates, rng=random):
+    """Pick one of the ready nodes, weighted by available inbound liquidity,
+    so invoices spread across nodes without draining the smallest one."""
+    if len(candidates) == 1:
+        return candidates[0]
+    weights = [max(node.state.snapshot.inbound_msat, 1) for node in candidates]
+    return rng.choices(candidates, weights=weights)[0]
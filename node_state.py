@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from pyln.client import RpcError
+
+logger = logging.getLogger(__name__)
+
+# Immutable view of the local node; replaced wholesale on every refresh
+NodeSnapshot = namedtuple("NodeSnapshot", [
+    "node_id",
+    "addresses",
+    "active_channels",
+    "total_channels",
+    "inbound_msat",
+    "updated_at",
+])
+
+
+def _msat(value):
+    """Amounts come back as ints on recent nodes and as '123msat' on older ones."""
+    if isinstance(value, str):
+        return int(value.replace("msat", ""))
+    return int(value or 0)
+
+
+class NodeStateCache:
+    """Keep node identity and local channel liquidity off the request path.
+
+    Identity (`getinfo`) is re-read every `identity_interval` seconds, and
+    `on_identity_change(snapshot)` is called when the node id or announced
+    addresses differ from the previous read. Local channel state is read
+    from `listpeerchannels` (or `listfunds` on nodes that predate it) in a
+    background thread every `refresh_interval` seconds, and immediately after
+    `refresh_soon()` is called, e.g. when an invoice settles.
+    """
+
+    def __init__(self, get_client, refresh_interval=30, identity_interval=300, on_identity_change=None):
+        self.get_client = get_client
+        self.refresh_interval = refresh_interval
+        self.identity_interval = identity_interval
+        self.on_identity_change = on_identity_change
+        self.snapshot = None
+        self._node_info = None
+        self._node_info_at = 0
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Initial node state refresh failed: {e}")
+        self._thread = threading.Thread(target=self._run, name="node-state", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def refresh_soon(self):
+        self._wake.set()
+
+    def refresh(self):
+        client = self.get_client()
+        identity_changed = False
+        if self._node_info is None or time.monotonic() - self._node_info_at >= self.identity_interval:
+            node_info = client.getinfo()
+            identity_changed = self._node_info is not None and (
+                (node_info["id"], node_info.get("address", []))
+                != (self._node_info["id"], self._node_info.get("address", []))
+            )
+            self._node_info, self._node_info_at = node_info, time.monotonic()
+        channels = self._local_channels(client)
+        active = [c for c in channels if c["active"]]
+        self.snapshot = NodeSnapshot(
+            node_id=self._node_info["id"],
+            addresses=self._node_info.get("address", []),
+            active_channels=len(active),
+            total_channels=len(channels),
+            inbound_msat=sum(c["inbound_msat"] for c in active),
+            updated_at=time.time(),
+        )
+        if identity_changed and self.on_identity_change is not None:
+            logger.info("Node identity or addresses changed")
+            self.on_identity_change(self.snapshot)
+        return self.snapshot
+
+    def _local_channels(self, client):
+        try:
+            return [
+                {
+                    "active": c.get("state") == "CHANNELD_NORMAL" and c.get("peer_connected", False),
+                    "inbound_msat": _msat(c.get("receivable_msat")),
+                }
+                for c in client.listpeerchannels()["channels"]
+            ]
+        except RpcError as e:
+            # listpeerchannels only exists on Core Lightning >= 23.02
+            if e.error.get("code") != -32601:
+                raise
+        return [
+            {
+                "active": c.get("state") == "CHANNELD_NORMAL" and c.get("connected", False),
+                "inbound_msat": _msat(c.get("amount_msat")) - _msat(c.get("our_amount_msat")),
+            }
+            for c in client.listfunds()["channels"]
+        ]
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Node state refresh failed: {e}")
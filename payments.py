@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from pyln.client import RpcError
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# pay error codes that no retry can fix: destination rejected the payment,
+# invoice expired, invalid parameters
+PERMANENT_PAY_ERRORS = {203, 207, -32602}
+
+
+PAYMENT_SECONDS = Histogram(
+    "payment_duration_seconds", "Payment job time from submission to completion",
+    ["status"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PaymentJob:
+    def __init__(self, bolt11):
+        self.id = uuid.uuid4().hex
+        self.bolt11 = bolt11
+        self.status = "queued"
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "attempts": self.attempts,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "queued_seconds": (self.started_at or end) - self.created_at,
+            "running_seconds": end - self.started_at if self.started_at else 0.0,
+        }
+
+
+def is_retryable(error):
+    if isinstance(error, RpcError):
+        return error.error.get("code") not in PERMANENT_PAY_ERRORS
+    return True
+
+
+class PaymentQueue:
+    """Run `pay` calls on a bounded worker pool instead of in web workers.
+
+    `submit()` returns a job right away; `workers` threads run `pay(bolt11)`
+    and retry failures up to `max_attempts` times with exponential backoff
+    (`backoff`, 2*`backoff`, ...). Retries wait on a timer, not in a worker.
+    Queued and running jobs are always kept for status queries, plus the
+    most recently finished ones up to `max_jobs` jobs in total.
+    """
+
+    def __init__(self, pay, workers=4, max_queued=100, max_attempts=3, backoff=2.0, max_jobs=1000):
+        self.pay = pay
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+        self.workers = workers
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"payment-worker-{i}", daemon=True).start()
+
+    def submit(self, bolt11):
+        job = PaymentJob(bolt11)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            raise QueueFull(f"{self._queue.maxsize} payments already queued")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status in ("queued", "running", "retrying"))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.attempts += 1
+            if job.started_at is None:
+                job.started_at = time.time()
+            try:
+                job.result = self.pay(job.bolt11)
+                job.status = "succeeded"
+                job.error = None
+                self._finish(job)
+            except Exception as e:
+                job.error = str(e)
+                if job.attempts < self.max_attempts and is_retryable(e):
+                    job.status = "retrying"
+                    delay = self.backoff * 2 ** (job.attempts - 1)
+                    logger.warning(f"Payment {job.id} failed (attempt {job.attempts}), retrying in {delay}s: {e}")
+                    threading.Timer(delay, self._queue.put, (job,)).start()
+                else:
+                    job.status = "failed"
+                    self._finish(job)
+                    logger.error(f"Payment {job.id} failed after {job.attempts} attempt(s): {e}")
+            finally:
+                self._queue.task_done()
+
+    def _finish(self, job):
+        job.finished_at = time.time()
+        PAYMENT_SECONDS.observe(job.finished_at - job.created_at, status=job.status)
+        with self._lock:
+            self._finished[job.id] = job
+            self._evict()
+
+    def _evict(self):
+        # Only finished jobs are evicted, oldest first: a live job stays queryable
+        while len(self._jobs) > self.max_jobs and self._finished:
+            self._jobs.pop(self._finished.popitem(last=False)[0], None)
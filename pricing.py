@@ -0,0 +1,197 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+
+import requests
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+MSAT_PER_BTC = 100_000_000_000
+
+RATE = Gauge("fiat_rate", "Fiat price of one bitcoin used for pricing")
+RATE_AGE = Gauge("fiat_rate_age_seconds", "Age of the exchange rate used for pricing")
+REFRESH_FAILURES = Counter("fiat_rate_refresh_failures_total", "Failed exchange rate fetches")
+
+# Immutable view of the current rate; replaced wholesale on every refresh.
+# `prices` maps each denomination to its rounded price in msat.
+RateSnapshot = namedtuple("RateSnapshot", ["rate", "prices", "source", "fetched_at"])
+
+
+class PriceUnavailable(Exception):
+    pass
+
+
+class StaticRateSource:
+    """A fixed rate, for offline testing or manual pricing."""
+
+    def __init__(self, rate):
+        self.rate = Decimal(str(rate))
+        self.name = "static"
+
+    def fetch(self):
+        return self.rate
+
+
+class FileRateSource:
+    """Rate read from a local file: a bare number or a JSON object such as {"EUR": 61234.5}."""
+
+    def __init__(self, path, currency="EUR"):
+        self.path = path
+        self.currency = currency
+        self.name = f"file:{path}"
+
+    def fetch(self):
+        with open(self.path, "r") as f:
+            content = f.read().strip()
+        value = json.loads(content)
+        if isinstance(value, dict):
+            value = value[self.currency]
+        return Decimal(str(value))
+
+
+class HttpRateSource:
+    """Rate from a JSON HTTP API. `field` is the dotted path to the number,
+    e.g. 'bitcoin.eur' for CoinGecko's simple/price endpoint."""
+
+    def __init__(self, url, field, timeout=5):
+        self.url = url
+        self.field = field
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.name = f"http:{url}"
+
+    def fetch(self):
+        response = self.session.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        value = response.json()
+        for key in self.field.split("."):
+            value = value[key]
+        return Decimal(str(value))
+
+
+def parse_rounding(value):
+    """Parse '25=100,100=1000' (rounding steps in sats) into {denomination: msat step}."""
+    rounding = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        denomination, sep, step = item.partition("=")
+        if not sep or int(step) <= 0:
+            raise ValueError(f"Invalid price rounding '{item}', expected denomination=sats")
+        rounding[denomination.strip()] = int(step) * 1000
+    return rounding
+
+
+def to_msat(fiat_amount, rate, step=1):
+    """Convert a fiat amount to msat at `rate` (fiat per BTC), rounded to a multiple of `step`."""
+    msat = Decimal(str(fiat_amount)) * MSAT_PER_BTC / rate
+    return max(step, int((msat / step).quantize(Decimal(1), rounding=ROUND_HALF_UP)) * step)
+
+
+class PriceEngine:
+    """Keep the exchange rate, and the price of each denomination, off the request path.
+
+    The rate is fetched from `source` in a background thread every
+    `refresh_interval` seconds and published as an immutable snapshot, so
+    requests read prices without locking or fetching. When fetches fail the
+    last known rate keeps being used; it is reported stale once older than
+    `max_age` seconds. Each denomination's price is rounded to the msat step
+    given in `rounding` (1 sat by default). `on_change(snapshot)` is called
+    when a refresh changes the rate.
+    """
+
+    def __init__(self, source, denominations, refresh_interval=60, max_age=600,
+                 rounding=None, default_step=1000, on_change=None):
+        self.source = source
+        self.denominations = list(denominations)
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.rounding = rounding or {}
+        self.default_step = default_step
+        self.on_change = on_change
+        self.snapshot = None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        RATE.set_function(lambda: float(self.snapshot.rate) if self.snapshot else 0)
+        RATE_AGE.set_function(lambda: self.age() or 0)
+
+    def start(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Initial exchange rate fetch failed: {e}")
+        threading.Thread(target=self._run, name="pricing", daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def refresh(self):
+        try:
+            rate = self.source.fetch()
+            if not rate > 0:
+                raise ValueError(f"Invalid rate {rate}")
+        except Exception:
+            REFRESH_FAILURES.inc()
+            raise
+        previous = self.snapshot
+        self.snapshot = RateSnapshot(
+            rate=rate,
+            prices={
+                d: to_msat(d, rate, self.rounding.get(d, self.default_step)) for d in self.denominations
+            },
+            source=self.source.name,
+            fetched_at=time.time(),
+        )
+        if self.on_change is not None and (previous is None or previous.rate != rate):
+            self.on_change(self.snapshot)
+        return self.snapshot
+
+    def age(self):
+        snapshot = self.snapshot
+        return time.time() - snapshot.fetched_at if snapshot else None
+
+    @property
+    def stale(self):
+        age = self.age()
+        return age is None or age > self.max_age
+
+    def _current(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            raise PriceUnavailable("No exchange rate available yet")
+        return snapshot
+
+    def price_msat(self, denomination):
+        """Price of a card denomination in msat, at the latest known rate."""
+        return self._current().prices[denomination]
+
+    def fiat_to_msat(self, fiat_amount, step=1000):
+        return to_msat(fiat_amount, self._current().rate, step)
+
+    def status(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {"available": False}
+        return {
+            "available": True,
+            "rate": float(snapshot.rate),
+            "source": snapshot.source,
+            "age_seconds": self.age(),
+            "stale": self.stale,
+            "prices_msat": snapshot.prices,
+        }
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Exchange rate refresh failed, keeping rate from {self.age() or 0:.0f}s ago: {e}")
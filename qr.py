@@ -0,0 +1,57 @@
+import io
+
+import qrcode
+import qrcode.image.svg
+
+from cache import LruCache
+from metrics import Counter, Histogram
+
+RENDER_SECONDS = Histogram("qr_render_duration_seconds", "QR code render time", ["format"])
+CACHE_REQUESTS = Counter("qr_cache_requests_total", "QR render cache lookups", ["result"])
+
+FORMATS = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+}
+
+
+class QrRenderer:
+    """Render invoice QR codes, keeping the most recent renders in memory.
+
+    BOLT11 strings are case-insensitive, so they are encoded upper-cased: the
+    QR alphanumeric mode then fits them in a noticeably smaller symbol. SVG
+    output is a single path and costs no raster work; PNG output uses small
+    modules and relies on the browser to scale the image up.
+    """
+
+    def __init__(self, max_entries=512, png_box_size=4, border=4):
+        self.png_box_size = png_box_size
+        self.border = border
+        self._cache = LruCache(max_entries)
+
+    def render(self, bolt11, fmt="svg"):
+        """Return the image bytes for `bolt11` in `fmt` ('svg' or 'png')."""
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported QR format: {fmt}")
+        key = (bolt11, fmt)
+        image = self._cache.get(key)
+        if image is None:
+            CACHE_REQUESTS.inc(result="miss")
+            with RENDER_SECONDS.time(format=fmt):
+                image = self._render(bolt11, fmt)
+            self._cache.put(key, image)
+        else:
+            CACHE_REQUESTS.inc(result="hit")
+        return image
+
+    def _render(self, bolt11, fmt):
+        qr = qrcode.QRCode(
+            box_size=self.png_box_size if fmt == "png" else 10,
+            border=self.border,
+            image_factory=qrcode.image.svg.SvgPathImage if fmt == "svg" else None,
+        )
+        qr.add_data(bolt11.upper())
+        qr.make(fit=True)
+        buffered = io.BytesIO()
+        qr.make_image().save(buffered)
+        return buffered.getvalue()
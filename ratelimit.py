@@ -0,0 +1,129 @@
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from metrics import Counter
+
+REJECTED = Counter("admission_rejected_total", "Requests rejected by admission control", ["scope", "reason"])
+
+# Refill `rate` tokens per second, up to `burst`
+Bucket = namedtuple("Bucket", ["rate", "burst"])
+
+
+def parse_bucket(value):
+    """Parse 'rate,burst' (e.g. '0.5,10'); an empty value disables the bucket."""
+    if not value or not value.strip():
+        return None
+    rate, _, burst = value.partition(",")
+    bucket = Bucket(float(rate), float(burst or rate))
+    # A zero rate would never refill, and a burst below one never admits a request
+    if not (bucket.rate > 0 and bucket.burst >= 1):
+        raise ValueError(f"Invalid rate limit '{value}', expected a rate above 0 and a burst of at least 1")
+    return bucket
+
+
+def _refill(tokens, updated, bucket, now):
+    return min(bucket.burst, tokens + (now - updated) * bucket.rate)
+
+
+class MemoryBackend:
+    """Token buckets in this process, bounded to `max_keys` (least recently used evicted)."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, bucket, cost=1.0):
+        """Take `cost` tokens; return 0 if allowed, else seconds until they are available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (bucket.burst, now))
+            tokens = _refill(tokens, updated, bucket, now)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / bucket.rate
+            self._buckets[key] = (tokens - cost if not wait else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SqliteBackend:
+    """Token buckets in the shared database, so every worker process sees the same counts."""
+
+    def __init__(self, storage, prune_every=1000, idle_ttl=3600):
+        self.storage = storage
+        self.prune_every = prune_every
+        self.idle_ttl = idle_ttl
+        self._calls = 0
+
+    def take(self, key, bucket, cost=1.0):
+        now = time.time()
+        self._calls += 1
+        with self.storage.transaction() as conn:
+            if self._calls % self.prune_every == 0:
+                # Buckets idle this long are full again: dropping them changes nothing
+                conn.execute('''
+                    DELETE FROM rate_limits WHERE updated < ?
+                ''', (now - self.idle_ttl,))
+            row = conn.execute('''
+                SELECT tokens, updated FROM rate_limits WHERE key = ?
+            ''', (key,)).fetchone()
+            tokens = _refill(*row, bucket, now) if row else bucket.burst
+            wait = 0.0 if tokens >= cost else (cost - tokens) / bucket.rate
+            conn.execute('''
+                INSERT OR REPLACE INTO rate_limits (key, tokens, updated) VALUES (?, ?, ?)
+            ''', (key, tokens - cost if not wait else tokens, now))
+        return wait
+
+
+class RateLimiter:
+    """Per-client and global token buckets for each scope.
+
+    `limits` maps a scope (e.g. 'create_invoice') to (per_client, global)
+    buckets, either of which may be None.
+    """
+
+    def __init__(self, backend, limits):
+        self.backend = backend
+        self.limits = limits
+
+    def check(self, scope, client, cost=1.0):
+        """Return 0 if the request may proceed, else the Retry-After delay in seconds."""
+        per_client, global_ = self.limits.get(scope, (None, None))
+        if per_client:
+            wait = self.backend.take(f"{scope}:{client}", per_client, cost)
+            if wait:
+                REJECTED.inc(scope=scope, reason="client_rate")
+                return wait
+        if global_:
+            wait = self.backend.take(f"{scope}:*", global_, cost)
+            if wait:
+                REJECTED.inc(scope=scope, reason="global_rate")
+                return wait
+        return 0
+
+
+class ConcurrencyLimiter:
+    """Cap requests in flight; excess requests are turned away instead of queued."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def retry_after_header(wait):
+    return str(max(1, math.ceil(wait)))
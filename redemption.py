@@ -0,0 +1,81 @@
+import re
+import threading
+import time
+
+from metrics import Counter
+
+CODE_PATTERN = re.compile(r"^GIFT-[0-9a-f]{16}$")
+
+LOOKUPS = Counter("gift_code_lookups_total", "Gift code lookups by how they were answered", ["result"])
+SYNCS = Counter("gift_code_index_syncs_total", "Incremental loads of newly issued gift codes")
+
+
+class CodeIndex:
+    """Every issued gift code, held in memory in front of SQLite.
+
+    The index is warmed from the database at startup and fed on issuance by
+    the process that settles invoices. Codes issued by another worker
+    process are picked up by an incremental load, run when a lookup misses
+    and the last load is older than `sync_interval` seconds; so a code
+    issued elsewhere is recognised within `sync_interval`. Codes that are
+    malformed or not in the index are rejected without a query, however many
+    are tried. Balances always come from the database, where redemptions
+    decrement them atomically.
+    """
+
+    def __init__(self, storage, sync_interval=1.0):
+        self.storage = storage
+        self.sync_interval = sync_interval
+        self._codes = set()
+        self._seq = 0
+        self._synced_at = 0.0
+        self._sync_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._codes)
+
+    def warm(self):
+        with self._sync_lock:
+            codes, self._seq = self.storage.load_issued_codes()
+            self._codes.update(codes)
+            self._synced_at = time.monotonic()
+        return len(codes)
+
+    def add(self, codes):
+        self._codes.update(codes)
+
+    def _sync(self):
+        """Load the codes issued since the last load, at most once per `sync_interval`."""
+        with self._sync_lock:
+            # Misses waiting on the lock share the load that just ran
+            if time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            codes, self._seq = self.storage.load_issued_codes(self._seq)
+            self._codes.update(codes)
+            self._synced_at = time.monotonic()
+            SYNCS.inc()
+
+    def rejects(self, code):
+        """Whether `code` is known not to exist, without asking for its card."""
+        if not CODE_PATTERN.match(code):
+            LOOKUPS.inc(result="malformed")
+            return True
+        if code not in self._codes:
+            self._sync()
+        if code in self._codes:
+            LOOKUPS.inc(result="index")
+            return False
+        LOOKUPS.inc(result="unknown")
+        return True
+
+    def get(self, code):
+        """Return (amount, balance) for `code`, or None if there is no such card."""
+        if self.rejects(code):
+            return None
+        return self.storage.get_gift_card(code)
+
+    def redeem(self, code, amount=None, redemption_id=None):
+        """Spend from the card; see Storage.redeem. Returns None if there is no such card."""
+        if self.rejects(code):
+            return None
+        return self.storage.redeem(code, amount, redemption_id)
@@ -0,0 +1,146 @@
+import logging
+import queue
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from pyln.client import LightningRpc
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+RPC_SECONDS = Histogram("lightning_rpc_duration_seconds", "Core Lightning RPC latency", ["method"])
+RPC_ERRORS = Counter("lightning_rpc_errors_total", "Failed Core Lightning RPC calls", ["method"])
+
+# Errors raised before the request reaches lightningd: safe to retry once
+CONNECT_ERRORS = (ConnectionRefusedError, FileNotFoundError)
+
+
+class RpcPool:
+    """Thread-safe pool of LightningRpc clients shared across Flask requests.
+
+    Clients are checked out for a single call, health-checked when they have
+    been idle for a while and dropped on socket errors so the next checkout
+    reconnects. Every call is timed per RPC method.
+    """
+
+    def __init__(self, socket_path, size=8, health_check_interval=30):
+        self.socket_path = socket_path
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self.client = PooledClient(self)
+
+    def _new_connection(self):
+        return LightningRpc(self.socket_path)
+
+    def _healthy(self):
+        """Check that lightningd still accepts connections on the socket."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(1)
+            sock.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def _acquire(self):
+        try:
+            rpc, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                return self._new_connection()
+            rpc, last_used = self._idle.get()
+
+        if time.monotonic() - last_used > self.health_check_interval and not self._healthy():
+            logger.warning("Lightning RPC socket unreachable, reconnecting")
+            return self._new_connection()
+        return rpc
+
+    def _release(self, rpc):
+        self._idle.put((rpc, time.monotonic()))
+
+    def _discard(self):
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """Check out a client for the duration of the block."""
+        rpc = self._acquire()
+        try:
+            yield rpc
+        except OSError:
+            self._discard()
+            raise
+        except BaseException:
+            self._release(rpc)
+            raise
+        else:
+            self._release(rpc)
+
+    def call(self, method, *args, **kwargs):
+        """Run `method` on a pooled client, retrying once if the connect fails."""
+        for attempt in range(2):
+            start = time.perf_counter()
+            try:
+                with self.connection() as rpc:
+                    result = getattr(rpc, method)(*args, **kwargs)
+            except CONNECT_ERRORS:
+                self.record(method, time.perf_counter() - start, error=True)
+                if attempt:
+                    raise
+                logger.warning(f"RPC {method}: connection failed, retrying")
+                continue
+            except Exception:
+                self.record(method, time.perf_counter() - start, error=True)
+                raise
+            self.record(method, time.perf_counter() - start)
+            return result
+
+    def record(self, method, elapsed, error=False):
+        """Account one call to `method` in the latency counters."""
+        RPC_SECONDS.observe(elapsed, method=method)
+        if error:
+            RPC_ERRORS.inc(method=method)
+        with self._stats_lock:
+            stats = self._stats.setdefault(method, {
+                "calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0
+            })
+            stats["calls"] += 1
+            stats["total_seconds"] += elapsed
+            stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+            if error:
+                stats["errors"] += 1
+
+    def stats(self):
+        """Per-method RPC latency counters."""
+        with self._stats_lock:
+            return {
+                method: dict(s, avg_seconds=s["total_seconds"] / s["calls"] if s["calls"] else 0.0)
+                for method, s in self._stats.items()
+            }
+
+
+class PooledClient:
+    """Drop-in replacement for LightningRpc that routes calls through a pool."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        def wrapper(*args, **kwargs):
+            return self._pool.call(name, *args, **kwargs)
+        return wrapper
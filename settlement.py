@@ -0,0 +1,142 @@
+import logging
+import threading
+from datetime import datetime
+
+from pyln.client import RpcError
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+SETTLED = Counter("gift_card_invoices_settled_total", "Gift card invoices settled")
+TIME_TO_SETTLE = Histogram(
+    "gift_card_time_to_settle_seconds", "Time from invoice creation to settlement",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+# Error code returned by waitanyinvoice when its timeout elapses
+WAITANYINVOICE_TIMEOUT = 904
+
+
+class SettlementWatcher(threading.Thread):
+    """Issue gift codes as soon as the node settles their invoice.
+
+    The watcher blocks on Core Lightning's `waitanyinvoice`, resuming from
+    the last `pay_index` it persisted, so no settlement is missed across
+    restarts and the request path never has to ask the node about payments.
+
+    With several worker processes, pass a `lease` name: only the process
+    holding that lease in storage watches the node, the others keep serving
+    `subscribe`/`wait_for` and take over if the leader stops renewing it.
+    """
+
+    def __init__(self, get_client, storage, timeout=30, retry_delay=5, on_settled=None,
+                 state_key="pay_index", lease=None, holder=None):
+        super().__init__(name="settlement-watcher", daemon=True)
+        self.get_client = get_client
+        self.storage = storage
+        self.on_settled = on_settled
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.state_key = state_key
+        self.lease = lease
+        self.holder = holder
+        # Renewed before every waitanyinvoice call, which returns within `timeout`
+        self.lease_ttl = 3 * timeout
+        self.is_leader = lease is None
+        self._stop_event = threading.Event()
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.lease and self.is_leader:
+            self.storage.release_lease(self.lease, self.holder)
+
+    def subscribe(self, payment_hash, callback):
+        """Call `callback()` from the watcher thread when `payment_hash` settles."""
+        with self._waiters_lock:
+            self._waiters.setdefault(payment_hash, []).append(callback)
+
+    def unsubscribe(self, payment_hash, callback):
+        with self._waiters_lock:
+            callbacks = self._waiters.get(payment_hash, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._waiters.pop(payment_hash, None)
+
+    def wait_for(self, payment_hash, timeout):
+        """Block until `payment_hash` settles or `timeout` seconds elapse.
+
+        Returns True if the watcher saw the settlement while waiting.
+        """
+        event = threading.Event()
+        self.subscribe(payment_hash, event.set)
+        try:
+            return event.wait(timeout)
+        finally:
+            self.unsubscribe(payment_hash, event.set)
+
+    def notify(self, payment_hash):
+        with self._waiters_lock:
+            callbacks = list(self._waiters.get(payment_hash, []))
+        for callback in callbacks:
+            callback()
+
+    def _hold_lease(self):
+        """Take or renew the lease; returns whether this process is the leader."""
+        if self.lease is None:
+            return True
+        try:
+            leader = self.storage.acquire_lease(self.lease, self.holder, self.lease_ttl)
+        except Exception as e:
+            logger.error(f"Could not renew settlement lease {self.lease}: {e}")
+            leader = False
+        if leader != self.is_leader:
+            logger.info(f"Settlement lease {self.lease} {'acquired' if leader else 'lost'}")
+        self.is_leader = leader
+        return leader
+
+    def run(self):
+        pay_index = None
+        while not self._stop_event.is_set():
+            if not self._hold_lease():
+                pay_index = None
+                self._stop_event.wait(self.retry_delay)
+                continue
+            try:
+                if pay_index is None:
+                    # Resume from what the previous leader persisted
+                    pay_index = self.storage.load_pay_index(self.state_key)
+                    logger.info(f"Settlement watcher started at pay_index {pay_index}")
+                invoice = self.get_client().waitanyinvoice(
+                    lastpay_index=pay_index, timeout=self.timeout
+                )
+                if invoice.get('status') == 'paid':
+                    self._settled(invoice)
+            except RpcError as e:
+                if e.error.get('code') == WAITANYINVOICE_TIMEOUT:
+                    continue
+                logger.error(f"waitanyinvoice failed: {e}")
+                self._stop_event.wait(self.retry_delay)
+                continue
+            except Exception as e:
+                # pay_index is not advanced: the same invoice comes back on the
+                # next call, and settle() never mints a second code for it
+                logger.error(f"Settlement watcher error: {e}")
+                self._stop_event.wait(self.retry_delay)
+                continue
+            pay_index = invoice.get('pay_index', pay_index)
+
+    def _settled(self, invoice):
+        completed = self.storage.settle([invoice['payment_hash']], invoice['pay_index'], self.state_key)
+        now = datetime.now()
+        if completed:
+            # A batch invoice completes several cards at once
+            SETTLED.inc()
+            TIME_TO_SETTLE.observe((now - datetime.fromisoformat(completed[0][1])).total_seconds())
+        self.notify(invoice['payment_hash'])
+        if self.on_settled:
+            self.on_settled(invoice)
+        logger.info(f"Invoice settled: {invoice['payment_hash']}")
@@ -0,0 +1,476 @@
+import json
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import Histogram
+
+QUERY_SECONDS = Histogram("sqlite_query_duration_seconds", "Gift card storage query latency", ["query"])
+
+# Core Lightning's default invoice expiry, used by invoices created without one
+DEFAULT_INVOICE_EXPIRY = 604800
+
+# Each entry moves the schema up one version (tracked in PRAGMA user_version)
+MIGRATIONS = [
+    # 1: original schema
+    '''
+    CREATE TABLE IF NOT EXISTS gift_cards
+    (id TEXT PRIMARY KEY,
+     amount INTEGER,
+     payment_hash TEXT,
+     code TEXT,
+     status TEXT,
+     created_at TIMESTAMP);
+    CREATE TABLE IF NOT EXISTS settlement_state
+    (key TEXT PRIMARY KEY,
+     value INTEGER);
+    ''',
+    # 2: unique indexes on the lookup columns
+    '''
+    DROP INDEX IF EXISTS idx_gift_cards_payment_hash;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_gift_cards_payment_hash ON gift_cards (payment_hash);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_gift_cards_code ON gift_cards (code);
+    ''',
+    # 3: a batch purchase pays several cards with one invoice
+    '''
+    DROP INDEX IF EXISTS idx_gift_cards_payment_hash;
+    CREATE INDEX IF NOT EXISTS idx_gift_cards_payment_hash ON gift_cards (payment_hash);
+    ''',
+    # 4: several workers and merchant nodes sharing the database
+    '''
+    ALTER TABLE gift_cards ADD COLUMN node_id TEXT;
+    CREATE TABLE IF NOT EXISTS leases
+    (name TEXT PRIMARY KEY,
+     holder TEXT,
+     expires_at REAL);
+    ''',
+    # 5: invoice expiry and archival of old cards
+    '''
+    ALTER TABLE gift_cards ADD COLUMN expires_at INTEGER;
+    CREATE INDEX IF NOT EXISTS idx_gift_cards_status_expires ON gift_cards (status, expires_at);
+    CREATE TABLE IF NOT EXISTS gift_cards_archive
+    (id TEXT PRIMARY KEY,
+     amount INTEGER,
+     payment_hash TEXT,
+     code TEXT,
+     status TEXT,
+     created_at TIMESTAMP,
+     node_id TEXT,
+     expires_at INTEGER,
+     archived_at TIMESTAMP);
+    CREATE INDEX IF NOT EXISTS idx_gift_cards_archive_payment_hash ON gift_cards_archive (payment_hash);
+    ''',
+    # 6: token buckets shared by the worker processes
+    '''
+    CREATE TABLE IF NOT EXISTS rate_limits
+    (key TEXT PRIMARY KEY,
+     tokens REAL,
+     updated REAL);
+    ''',
+    # 7: redemption, completed cards carry a spendable balance
+    '''
+    ALTER TABLE gift_cards ADD COLUMN balance INTEGER;
+    UPDATE gift_cards SET balance = amount WHERE status = 'completed';
+    CREATE TABLE IF NOT EXISTS gift_card_redemptions
+    (code TEXT,
+     id TEXT,
+     amount INTEGER,
+     balance INTEGER,
+     created_at TIMESTAMP,
+     PRIMARY KEY (code, id));
+    CREATE INDEX IF NOT EXISTS idx_gift_cards_archive_code ON gift_cards_archive (code);
+    ''',
+    # 8: LNURL-channel k1 sessions shared by the worker processes
+    '''
+    CREATE TABLE IF NOT EXISTS channel_sessions
+    (k1 TEXT PRIMARY KEY,
+     status TEXT,
+     remote_id TEXT,
+     amount INTEGER,
+     private INTEGER,
+     result TEXT,
+     error TEXT,
+     expires_at REAL);
+    ''',
+    # 9: cards created before migration 5 have no expires_at; their invoices
+    # used the default expiry. created_at is local time.
+    f'''
+    UPDATE gift_cards
+    SET expires_at = CAST(strftime('%s', created_at, 'utc') AS INTEGER) + {DEFAULT_INVOICE_EXPIRY}
+    WHERE status = 'pending' AND expires_at IS NULL;
+    ''',
+    # 10: issue order of the gift codes, for incremental loads of the code index
+    '''
+    ALTER TABLE gift_cards ADD COLUMN issued_seq INTEGER;
+    UPDATE gift_cards SET issued_seq = rowid WHERE code IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_gift_cards_issued_seq ON gift_cards (issued_seq);
+    INSERT OR REPLACE INTO settlement_state (key, value)
+    SELECT 'issued_seq', COALESCE(MAX(issued_seq), 0) FROM gift_cards;
+    ''',
+]
+
+
+def _statements(script):
+    """Split a migration script into statements, keeping ';' inside literals."""
+    statement = ""
+    for part in script.split(";"):
+        statement += part + ";"
+        if sqlite3.complete_statement(statement):
+            if statement.strip(" \n;"):
+                yield statement.strip()
+            statement = ""
+
+
+class Storage:
+    """Gift card storage on SQLite, over a bounded pool of long-lived connections.
+
+    Each query or transaction checks out a connection and returns it, so
+    short-lived request threads reuse connections instead of opening their
+    own; at most `pool_size` are open, further callers wait for one to be
+    returned. The database runs in WAL mode with synchronous=NORMAL, so
+    readers never block the writer and commits do not fsync the main
+    database file. Queries use constant SQL strings, which sqlite3 keeps
+    prepared in the per-connection statement cache.
+    """
+
+    def __init__(self, path, busy_timeout=5.0, pool_size=8):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.pool_size = pool_size
+        # Most recently used first, so a quiet period keeps reusing warm connections
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            cached_statements=256,
+            # Checked out by one thread at a time, but not always the same one
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.pool_size
+                if can_create:
+                    self._created += 1
+            if not can_create:
+                return self._idle.get()
+        try:
+            return self._connect()
+        except BaseException:
+            self._discard()
+            raise
+
+    def _discard(self):
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the block."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                # Left open by a failed COMMIT or ROLLBACK: do not hand it out again
+                conn.close()
+                self._discard()
+            else:
+                self._idle.put(conn)
+
+    def close(self):
+        """Close the idle connections; connections in use are reopened on demand."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            self._discard()
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in a single write transaction."""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    def migrate(self):
+        """Apply pending schema migrations.
+
+        The schema version is read inside the write transaction, so processes
+        starting together never apply the same migration twice.
+        """
+        with self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                # executescript() would commit first: run the statements one by one
+                for statement in _statements(script):
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+        return len(MIGRATIONS)
+
+    def insert_gift_cards(self, rows, node_id=None, expires_at=None):
+        """Insert pending cards given as (id, amount, payment_hash) in one transaction.
+
+        `node_id` records the merchant node that issued their invoice and
+        `expires_at` (unix time) when that invoice expires.
+        """
+        now = datetime.now().isoformat(" ")
+        with QUERY_SECONDS.time(query="insert_gift_cards"), self.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO gift_cards (id, amount, payment_hash, status, created_at, node_id, expires_at)
+                VALUES (?, ?, ?, 'pending', ?, ?, ?)
+            ''', [(id, amount, payment_hash, now, node_id, expires_at) for id, amount, payment_hash in rows])
+
+    def insert_gift_card(self, id, amount, payment_hash, node_id=None, expires_at=None):
+        self.insert_gift_cards([(id, amount, payment_hash)], node_id, expires_at)
+
+    def get_payment(self, payment_hash):
+        """Return [(amount, status, code), ...] for the cards paid by `payment_hash`.
+
+        A single purchase has one card, a batch purchase several; the list is
+        empty if the hash is unknown.
+        """
+        with QUERY_SECONDS.time(query="get_payment"), self.connection() as conn:
+            cards = conn.execute('''
+                SELECT amount, status, code FROM gift_cards WHERE payment_hash = ?
+                ORDER BY rowid
+            ''', (payment_hash,)).fetchall()
+            if not cards:
+                cards = conn.execute('''
+                    SELECT amount, status, code FROM gift_cards_archive WHERE payment_hash = ?
+                    ORDER BY id
+                ''', (payment_hash,)).fetchall()
+            return cards
+
+    def get_payments(self, payment_hashes):
+        """Return {payment_hash: [(amount, status, code), ...]} for the known hashes.
+
+        One query on the live table, plus one on the archive for hashes not found there.
+        """
+        with QUERY_SECONDS.time(query="get_payments"), self.connection() as conn:
+            rows = conn.execute('''
+                SELECT payment_hash, amount, status, code FROM gift_cards
+                WHERE payment_hash IN (SELECT value FROM json_each(?))
+                ORDER BY rowid
+            ''', (json.dumps(list(payment_hashes)),)).fetchall()
+            missing = set(payment_hashes).difference(row[0] for row in rows)
+            if missing:
+                rows += conn.execute('''
+                    SELECT payment_hash, amount, status, code FROM gift_cards_archive
+                    WHERE payment_hash IN (SELECT value FROM json_each(?))
+                    ORDER BY id
+                ''', (json.dumps(list(missing)),)).fetchall()
+        payments = {}
+        for payment_hash, amount, status, code in rows:
+            payments.setdefault(payment_hash, []).append((amount, status, code))
+        return payments
+
+    def settle(self, settled, pay_index=None, state_key="pay_index"):
+        """Mint gift codes for settled payments, exactly once.
+
+        `settled` is a list of payment hashes. Each pending (or legacy 'paid',
+        or 'expired' by a sweep that raced the payment) card moves to
+        'completed' with its code in one write transaction, so
+        concurrent callers or workers can never mint a second code; rows that
+        are already completed are left untouched. `pay_index`, when given, is
+        persisted under `state_key` in the same transaction. Each new code gets
+        the next `issued_seq`, see load_issued_codes().
+
+        Returns (payment_hash, created_at) for every card completed by this call.
+        """
+        completed = []
+        with QUERY_SECONDS.time(query="settle"), self.transaction() as conn:
+            row = conn.execute('''
+                SELECT value FROM settlement_state WHERE key = 'issued_seq'
+            ''').fetchone()
+            seq = row[0] if row else 0
+            for payment_hash in settled:
+                rows = conn.execute('''
+                    SELECT id, created_at FROM gift_cards
+                    WHERE payment_hash = ? AND status IN ('pending', 'paid', 'expired')
+                ''', (payment_hash,)).fetchall()
+                conn.executemany('''
+                    UPDATE gift_cards SET status = 'completed', code = ?, balance = amount, issued_seq = ?
+                    WHERE id = ? AND status IN ('pending', 'paid', 'expired')
+                ''', [(f"GIFT-{secrets.token_hex(8)}", seq + i, id) for i, (id, _) in enumerate(rows, start=1)])
+                seq += len(rows)
+                completed.extend((payment_hash, created_at) for _, created_at in rows)
+            if completed:
+                conn.execute('''
+                    INSERT OR REPLACE INTO settlement_state (key, value) VALUES ('issued_seq', ?)
+                ''', (seq,))
+            if pay_index is not None:
+                conn.execute('''
+                    INSERT OR REPLACE INTO settlement_state (key, value)
+                    VALUES (?, ?)
+                ''', (state_key, pay_index))
+        return completed
+
+    def expire_pending(self, before):
+        """Mark pending cards whose invoice expired before `before` (unix time); returns the count.
+
+        Cards without an expiry are taken to have had the default one.
+        """
+        cutoff = datetime.fromtimestamp(before - DEFAULT_INVOICE_EXPIRY).isoformat(" ")
+        with QUERY_SECONDS.time(query="expire_pending"), self.transaction() as conn:
+            return conn.execute('''
+                UPDATE gift_cards SET status = 'expired'
+                WHERE status = 'pending'
+                AND (expires_at < ? OR (expires_at IS NULL AND created_at < ?))
+            ''', (before, cutoff)).rowcount
+
+    def archive(self, before, batch_size=1000):
+        """Move fully spent and expired cards created before `before` (a datetime)
+        to gift_cards_archive, `batch_size` rows per transaction; returns the count.
+
+        Cards with a balance left stay in gift_cards, however old.
+        """
+        cutoff = before.isoformat(" ")
+        archived = 0
+        while True:
+            with QUERY_SECONDS.time(query="archive"), self.transaction() as conn:
+                ids = [row[0] for row in conn.execute('''
+                    SELECT id FROM gift_cards
+                    WHERE (status = 'expired' OR (status = 'completed' AND balance = 0))
+                    AND created_at < ?
+                    LIMIT ?
+                ''', (cutoff, batch_size))]
+                if not ids:
+                    return archived
+                conn.execute('''
+                    INSERT OR REPLACE INTO gift_cards_archive
+                    (id, amount, payment_hash, code, status, created_at, node_id, expires_at, archived_at)
+                    SELECT id, amount, payment_hash, code, status, created_at, node_id, expires_at, ?
+                    FROM gift_cards WHERE id IN (SELECT value FROM json_each(?))
+                ''', (datetime.now().isoformat(" "), json.dumps(ids)))
+                conn.execute('''
+                    DELETE FROM gift_cards WHERE id IN (SELECT value FROM json_each(?))
+                ''', (json.dumps(ids),))
+            archived += len(ids)
+
+    def load_issued_codes(self, after_seq=0):
+        """Return (codes, seq): the codes issued after `after_seq`, and the
+        sequence number of the last one to pass back next time.
+
+        A first load (after_seq=0) also includes the archived codes.
+        """
+        with QUERY_SECONDS.time(query="load_issued_codes"), self.connection() as conn:
+            # Codes up to this value are committed: settle() bumps it in the same transaction
+            row = conn.execute('''
+                SELECT value FROM settlement_state WHERE key = 'issued_seq'
+            ''').fetchone()
+            seq = row[0] if row else 0
+            codes = [code for code, in conn.execute('''
+                SELECT code FROM gift_cards WHERE issued_seq > ? AND issued_seq <= ?
+            ''', (after_seq, seq))]
+            if not after_seq:
+                codes += [code for code, in conn.execute('''
+                    SELECT code FROM gift_cards_archive WHERE code IS NOT NULL
+                ''')]
+        return codes, seq
+
+    def get_gift_card(self, code):
+        """Return (amount, balance) for the card with `code`, or None if there is none.
+
+        Archived cards are fully spent.
+        """
+        with QUERY_SECONDS.time(query="get_gift_card"), self.connection() as conn:
+            card = conn.execute('''
+                SELECT amount, balance FROM gift_cards WHERE code = ? AND status = 'completed'
+            ''', (code,)).fetchone()
+            if card is None:
+                card = conn.execute('''
+                    SELECT amount, 0 FROM gift_cards_archive WHERE code = ?
+                ''', (code,)).fetchone()
+            return card
+
+    def redeem(self, code, amount=None, redemption_id=None):
+        """Spend `amount` (the whole balance if None) from the card with `code`.
+
+        The balance is read and decremented in one write transaction, so
+        concurrent redemptions, from any worker, can never spend more than the
+        card holds. A `redemption_id` makes retries safe: replaying it returns
+        the first outcome without spending again.
+
+        Returns (redeemed, balance): redeemed is 0 if the balance is too low.
+        Returns None if no card has `code`.
+        """
+        redemption_id = redemption_id or secrets.token_hex(8)
+        with QUERY_SECONDS.time(query="redeem"), self.transaction() as conn:
+            previous = conn.execute('''
+                SELECT amount, balance FROM gift_card_redemptions WHERE code = ? AND id = ?
+            ''', (code, redemption_id)).fetchone()
+            if previous:
+                return previous
+            card = conn.execute('''
+                SELECT balance FROM gift_cards WHERE code = ? AND status = 'completed'
+            ''', (code,)).fetchone()
+            if card is None:
+                return None
+            balance = card[0]
+            spend = balance if amount is None else amount
+            if spend <= 0 or spend > balance:
+                return 0, balance
+            conn.execute('''
+                UPDATE gift_cards SET balance = balance - ? WHERE code = ? AND balance >= ?
+            ''', (spend, code, spend))
+            conn.execute('''
+                INSERT INTO gift_card_redemptions (code, id, amount, balance, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (code, redemption_id, spend, balance - spend, datetime.now().isoformat(" ")))
+        return spend, balance - spend
+
+    def load_pay_index(self, state_key="pay_index"):
+        with self.connection() as conn:
+            row = conn.execute('''
+                SELECT value FROM settlement_state WHERE key = ?
+            ''', (state_key,)).fetchone()
+        return row[0] if row else 0
+
+    def acquire_lease(self, name, holder, ttl):
+        """Take or renew the lease `name` for `ttl` seconds.
+
+        Succeeds if the lease is free, expired or already held by `holder`;
+        returns whether `holder` holds it afterwards.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('''
+                INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE
+                SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            ''', (name, holder, now + ttl, now))
+            row = conn.execute('''
+                SELECT holder FROM leases WHERE name = ?
+            ''', (name,)).fetchone()
+        return row is not None and row[0] == holder
+
+    def release_lease(self, name, holder):
+        with self.transaction() as conn:
+            conn.execute('''
+                DELETE FROM leases WHERE name = ? AND holder = ?
+            ''', (name, holder))